@@ -13,56 +13,137 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import hashlib
+import logging
+import random
 from datetime import datetime, time
 from time import strftime
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.api import oauth
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
 from models import ConflictException
+from models import Attendee
+from models import AttendeeCountForm
+from models import AttendeeForm
+from models import AttendeeForms
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import StringMessage
 from models import BooleanMessage
+from models import CacheStatsForm
+from models import CacheStatsForms
+from models import InstrumentationForm
+from models import InstrumentationForms
+from models import LatencyBucketForm
+from models import RpcCountForm
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
+from models import ConferenceDetailForm
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import NearlySoldOut
+from models import SeatShard
+from models import Backfill
+from models import MEMCACHE_SESSION_PREFIX
+from models import POPULAR_MAX_SEATS
+from models import POPULAR_MIN_ATTENDEES
 from models import TeeShirtSize
 from models import Session
 from models import SessionForm
 from models import SessionForms
 from models import Speaker
+from models import ConferenceSpeakers
+from models import ConferenceSchedule
 from models import SpeakerForm
 from models import SpeakerForms
+from models import WishlistEntry
+from models import WishlistForm
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
-from utils import getUserId
+from converters import copyToForm
+from instrumentation import COUNTERS
+from instrumentation import getStats
+from instrumentation import instrumented
+from instrumentation import LATENCY_BUCKETS_MS
+from queryplanner import planQuery
+from utils import currentRequest
+from utils import LocalCache
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+NEARLY_SOLD_OUT_SEATS = 5
+# conferences re-checked per NearlySoldOut transaction; together with
+# the NearlySoldOut entity this stays within the 25 entity groups a
+# cross group transaction may touch
+NEARLY_SOLD_OUT_BATCH = 24
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+ATTENDING_BATCH_SIZE = 25   # registered conferences read per batch
+MAX_SEAT_SHARDS = 50
+MEMCACHE_SEAT_SYNC_PREFIX = "SEAT_SYNC_"
+SEAT_SYNC_DELAY = 10    # seconds between seatsAvailable syncs of sharded confs
+MEMCACHE_ROSTER_INDEX_PREFIX = "ROSTER_INDEX_"
+ROSTER_INDEX_BATCH = 50     # registrations indexed per task
+ROSTER_INDEX_TTL = 600      # seconds before indexing may be started again
+MEMCACHE_MIGRATION_KEY = "MIGRATING_REGISTRATIONS"
+MIGRATION_BATCH = 25        # Profiles per transaction, the xg limit
+MIGRATION_TTL = 3600        # seconds before a migration may be started again
+MEMCACHE_BACKFILL_PREFIX = "BACKFILL_"
+BACKFILL_BATCH = 25         # entities re-put per transaction, the xg limit
+BACKFILL_TTL = 3600         # seconds before a backfill may be started again
+FEATURED_SPEAKER_DELAY = 5   # seconds a featured speaker check is coalesced
+MEMCACHE_FEATURED_PENDING_PREFIX = "FEATURED_SPEAKER_PENDING_"
+MAX_IMPORT_SESSIONS = 500
+MEMCACHE_CONFERENCE_PREFIX = "CONFERENCE_"
+CONFERENCE_CACHE_TTL = 300  # seconds
+MEMCACHE_CACHE_STATS_PREFIX = "CACHE_STATS_"
+MEMCACHE_SCHEDULE_PREFIX = "SCHEDULE_"
+SCHEDULE_CACHE_TTL = 600    # seconds
+# seconds an invalidated cache entry can't be filled again, so a reader
+# that loaded the old data before the invalidation can't cache it
+CACHE_FILL_LOCK = 10
+SESSION_CACHE_TTL = 3600    # seconds
+CACHE_NAMES = ('conference', 'schedule', 'session')
+ORGANISER_NAMES_SIZE = 5000
+ORGANISER_NAMES_TTL = 60    # seconds
+# user id -> organiser displayName, shared by all requests of an instance
+_organiserNames = LocalCache(ORGANISER_NAMES_SIZE, ORGANISER_NAMES_TTL)
+
+# backfills re-putting every entity of a kind, by name; completed ones
+# are remembered per instance
+BACKFILLS = {
+    'conferencePopular': Conference,
+    'speakerSearchTerms': Speaker,
+}
+_backfillsDone = set()
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
     "city": "Default City",
     "maxAttendees": 0,
     "seatsAvailable": 0,
+    "seatShards": 0,
     "topics": [ "Default", "Topic" ],
 }
 
@@ -91,6 +172,25 @@ CONF_TYPE_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     typeOfSession=messages.StringField(2),
+    ifNoneMatch=messages.StringField(3),
+)
+
+CONF_SESSIONS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
+CONDITIONAL_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+)
+
+CONF_ATTENDING_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
 )
 
 CONF_POST_REQUEST = endpoints.ResourceContainer(
@@ -103,11 +203,38 @@ SESSION_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(2),
 )
 
+SESSIONS_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(2),
+)
+
+SPEAKERS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    prefix=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
+CONF_ATTENDEES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
 SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speakerId=messages.StringField(1),
 )
 
+SPEAKER_SESSIONS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    speakerId=messages.StringField(1),
+    websafeConferenceKey=messages.StringField(2),
+    pageSize=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
+)
+
 WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     sessionKey=messages.StringField(1),
@@ -138,29 +265,44 @@ class ConferenceApi(remote.Service):
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+        return copyToForm(conf, ConferenceForm, organizerDisplayName=displayName)
+
+
+    @staticmethod
+    @ndb.tasklet
+    def _getOrganiserNamesAsync(user_ids):
+        """Return {user id: displayName} for the given organisers, looking
+        each one up once: from the local cache, or all in one get_multi."""
+        user_ids = set(user_id for user_id in user_ids if user_id)
+        names = _organiserNames.getMulti(user_ids)
+        missing = [user_id for user_id in user_ids if user_id not in names]
+        if missing:
+            profiles = yield ndb.get_multi_async(
+                [ndb.Key(Profile, user_id) for user_id in missing])
+            found = dict((user_id, getattr(prof, 'displayName', None))
+                         for user_id, prof in zip(missing, profiles))
+            _organiserNames.setMulti(found)
+            names.update(found)
+        raise ndb.Return(names)
+
+
+    def _copyConferencesToForms(self, conferences, **kwargs):
+        """Return ConferenceForms for conferences, with all organiser
+        names resolved in one batch."""
+        conferences = list(conferences)
+        names = self._getOrganiserNamesAsync(
+            conf.organizerUserId for conf in conferences).get_result()
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+                   for conf in conferences],
+            **kwargs
+        )
 
 
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = self._getUserId()
 
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
@@ -188,6 +330,9 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
+        if not 0 <= data["seatShards"] <= MAX_SEAT_SHARDS:
+            raise endpoints.BadRequestException(
+                "seatShards must be between 0 and %d." % MAX_SEAT_SHARDS)
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
@@ -195,11 +340,18 @@ class ConferenceApi(remote.Service):
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
-
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
+        # a new conference has no registrations to index
+        data['rosterIndexed'] = True
+
+        # create Conference (and its seat shards), send email to organizer
+        # confirming creation of Conference & return (modified) ConferenceForm;
+        # shards are written first, as without the Conference they are
+        # harmless, while a Conference without its shards has no seats
+        conf = Conference(**data)
+        if conf.seatShards:
+            ndb.put_multi(self._createSeatShards(conf))
+        conf.put()
+        taskqueue.add(params={'email': currentRequest().user().email(),
             'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email'
         )
@@ -208,10 +360,7 @@ class ConferenceApi(remote.Service):
 
     @ndb.transactional()
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = self._getUserId()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
@@ -228,12 +377,24 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # seats of a sharded conference are counted on its shards, which
+        # this transaction doesn't touch; don't let the two drift apart
+        if conf.seatShards:
+            for name in ('maxAttendees', 'seatsAvailable'):
+                data = getattr(request, name)
+                if data is not None and data != getattr(conf, name):
+                    raise endpoints.BadRequestException(
+                        "%s can't be changed on a conference with seat "
+                        "shards." % name)
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        seatsBefore, nameBefore = conf.seatsAvailable, conf.name
         for field in request.all_fields():
             data = getattr(request, field.name)
-            # only copy fields where we get data
-            if data not in (None, []):
+            # only copy fields where we get data; the number of
+            # seat shards is fixed once the conference is created
+            if data not in (None, []) and field.name != 'seatShards':
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
@@ -242,12 +403,15 @@ class ConferenceApi(remote.Service):
                 # write to Conference object
                 setattr(conf, field.name, data)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
+        self._updateNearlySoldOut(conf, seatsBefore, nameBefore)
+        self._invalidateConferenceCache(request.websafeConferenceKey)
+        prof = currentRequest().profileAsync().get_result()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @instrumented
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -256,70 +420,117 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @instrumented
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
+        # read the organiser's Profile while the update runs
+        self._getUserId()
+        currentRequest().profileAsync()
         return self._updateConferenceObject(request)
 
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @instrumented
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
+        return self._getConferenceFormAsync(
+            request.websafeConferenceKey).get_result()
+
+
+    @ndb.tasklet
+    def _getConferenceFormAsync(self, wsck):
+        """Return the ConferenceForm of a conference, served from memcache
+        once rendered."""
+        # serve the rendered ConferenceForm from memcache if we can
+        ctx = ndb.get_context()
+        cached = yield ctx.memcache_get(MEMCACHE_CONFERENCE_PREFIX + wsck)
+        self._countCacheLookup('conference', cached is not None)
+        if cached is not None:
+            raise ndb.Return(protojson.decode_message(ConferenceForm, cached))
+
+        # get Conference and organiser name (its parent Profile)
+        # concurrently; bail if not found
         try:
-            conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+            c_key = ndb.Key(urlsafe=wsck)
         except ProtocolBufferDecodeError:
-            print('No conference found with key: %s' % request.websafeConferenceKey)
+            print('No conference found with key: %s' % wsck)
             raise
-
-        prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        conf, names = yield (c_key.get_async(),
+                             self._getOrganiserNamesAsync([c_key.parent().id()]))
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        # return ConferenceForm, with live seat count for sharded conferences
+        cf = self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+        if conf.seatShards:
+            cf.seatsAvailable = yield self._getSeatsAvailableAsync(conf)
+        # add, so that a form invalidated since it was read is not
+        # cached again
+        yield ctx.memcache_add(MEMCACHE_CONFERENCE_PREFIX + wsck,
+            protojson.encode_message(cf), time=CONFERENCE_CACHE_TTL)
+        raise ndb.Return(cf)
+
+
+    @endpoints.method(CONF_GET_REQUEST, ConferenceDetailForm,
+            path='conference/{websafeConferenceKey}/detail',
+            http_method='GET', name='getConferenceDetail')
+    @instrumented
+    def getConferenceDetail(self, request):
+        """Return a conference with its sessions and, for a signed in
+        user, whether they attend or organise it and which of its sessions
+        they wishlisted; everything is read concurrently."""
+        wsck = request.websafeConferenceKey
+        context = currentRequest()
+        user_id = context.userId()
+        if user_id:
+            prof = context.profileAsync()
+            entries = WishlistEntry.query(
+                ancestor=ndb.Key(Profile, user_id)).fetch_async(keys_only=True)
+        conference = self._getConferenceFormAsync(wsck)
+        schedule = self._getScheduleAsync(wsck)
+
+        detail = ConferenceDetailForm(conference=conference.get_result())
+        etag, forms = schedule.get_result()
+        detail.sessions = protojson.decode_message(SessionForms, forms).items
+        if user_id:
+            detail.isOwner = detail.conference.organizerUserId == user_id
+            prof = prof.get_result()
+            if prof:
+                detail.isAttending = (ndb.Key(urlsafe=wsck) in
+                                      self._getRegistrations(prof))
+                wishlist = set(key.urlsafe() for key in prof.sessionWishlist)
+                wishlist.update(key.id() for key in entries.get_result())
+                detail.wishlist = [sf.websafeKey for sf in detail.sessions
+                                   if sf.websafeKey in wishlist]
+        return detail
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = self._getUserId()
 
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
-        )
+        return self._copyConferencesToForms(confs)
 
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+    def _getQueryPlan(self, request):
+        """Return the QueryPlan for the submitted filters."""
+        return planQuery(self._formatFilters(request.filters))
 
 
     def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
+        """Parse, check validity and format user supplied filters as
+        (field, operator, value) tuples."""
         formatted_filters = []
         inequality_field = None
 
@@ -342,92 +553,210 @@ class ConferenceApi(remote.Service):
                 else:
                     inequality_field = filtr["field"]
 
-            formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter on %s needs a number." % filtr["field"])
+
+            formatted_filters.append(
+                (filtr["field"], filtr["operator"], filtr["value"]))
+        return formatted_filters
+
+
+    def _getPageSize(self, request):
+        """Return the checked page size of a paged request."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if page_size < 1 or page_size > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d." % MAX_PAGE_SIZE)
+        return page_size
+
+
+    def _getPageParams(self, request):
+        """Return (page size, start cursor) from a paged request."""
+        page_size = self._getPageSize(request)
+
+        cursor = None
+        if request.pageToken:
+            try:
+                cursor = Cursor(urlsafe=request.pageToken)
+            except datastore_errors.BadValueError:
+                raise endpoints.BadRequestException("Invalid pageToken.")
+        return page_size, cursor
 
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
+    @instrumented
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        """Query for conferences, one page at a time.
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        Filters the chosen index cannot serve are applied in memory, so a
+        page may hold fewer than pageSize conferences while more follow.
+        """
+        page_size, cursor = self._getPageParams(request)
+        plan = self._getQueryPlan(request)
+        description = plan.describe()
+        logging.info('queryConferences plan: %s', description)
+        conferences, next_cursor, more = plan.fetchPage(
+            page_size, start_cursor=cursor)
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+        return self._copyConferencesToForms(conferences,
+            nextPageToken=next_cursor.urlsafe() if more and next_cursor else None,
+            queryPlan=description)
+
+
+# - - - Caching - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _etag(*parts):
+        """Return a version token for a response built from parts."""
+        return hashlib.md5(u'|'.join(unicode(part) for part in parts)
+                           .encode('utf-8')).hexdigest()
+
+
+    @staticmethod
+    def _invalidateConferenceCache(wsck):
+        """Drop the cached ConferenceForm; inside a transaction this is
+        deferred until the transaction has committed."""
+        ndb.get_context().call_on_commit(
+            lambda: memcache.delete(MEMCACHE_CONFERENCE_PREFIX + wsck,
+                                    seconds=CACHE_FILL_LOCK))
+
+
+    @staticmethod
+    def _countCacheLookup(name, hit, count=1):
+        """Count cache hits or misses without waiting for memcache."""
+        if count:
+            key = '%s%s_%s' % (MEMCACHE_CACHE_STATS_PREFIX, name,
+                               'hits' if hit else 'misses')
+            memcache.Client().incr_async(key, delta=count, initial_value=0)
+
+
+    @endpoints.method(message_types.VoidMessage, CacheStatsForms,
+            path='cacheStats',
+            http_method='GET', name='getCacheStats')
+    @instrumented
+    def getCacheStats(self, request):
+        """Return hit/miss counters of the server side caches."""
+        keys = ['%s%s_%s' % (MEMCACHE_CACHE_STATS_PREFIX, name, kind)
+                for name in CACHE_NAMES for kind in ('hits', 'misses')]
+        counts = memcache.get_multi(keys)
+        return CacheStatsForms(items=[CacheStatsForm(
+            name=name,
+            hits=counts.get('%s%s_hits' % (MEMCACHE_CACHE_STATS_PREFIX, name), 0),
+            misses=counts.get('%s%s_misses' % (MEMCACHE_CACHE_STATS_PREFIX, name), 0))
+            for name in CACHE_NAMES]
         )
 
 
+    @endpoints.method(message_types.VoidMessage, InstrumentationForms,
+            path='instrumentationStats',
+            http_method='GET', name='getInstrumentationStats')
+    @instrumented
+    def getInstrumentationStats(self, request):
+        """Return latency histograms and RPC counts per API method and
+        handler (admins only)."""
+        try:
+            is_admin = oauth.is_current_user_admin(EMAIL_SCOPE)
+        except oauth.Error:
+            is_admin = False
+        if not is_admin:
+            raise endpoints.ForbiddenException('Admin access required.')
+
+        forms = InstrumentationForms()
+        for name, counts in sorted(getStats().iteritems()):
+            form = InstrumentationForm(name=name)
+            for field in COUNTERS:
+                setattr(form, field, counts[field])
+            for i, bound in enumerate(LATENCY_BUCKETS_MS + (None,)):
+                form.latency.append(LatencyBucketForm(
+                    upperMs=bound, count=counts['latency_%d' % i]))
+            for key, count in sorted(counts.iteritems()):
+                if key.startswith('rpc_') and count:
+                    form.rpcs.append(RpcCountForm(name=key[4:], count=count))
+            forms.items.append(form)
+        return forms
+
+
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                elif field.name == 'sessionWishlist':
-                    setattr(pf, field.name, [k.urlsafe() for k in getattr(prof, field.name)])
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        return copyToForm(prof, ProfileForm,
+            conferenceKeysToAttend=[
+                key.urlsafe() for key in self._getRegistrations(prof)],
+            sessionWishlist=[
+                key.urlsafe() for key in self._getWishlistKeys(prof)])
 
 
-    def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if non-existent."""
+    def _getUserId(self):
+        """Return the signed in user's id, looked up once per request."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
+        user_id = currentRequest().userId()
+        if not user_id:
             raise endpoints.UnauthorizedException('Authorization required')
+        return user_id
+
+
+    def _getProfileFromUser(self, fresh=False):
+        """Return user Profile from datastore, creating new one if non-existent."""
+        profile, created = self._loadProfile(fresh)
+        if created:
+            profile.put()
+        return profile      # return Profile
+
 
+    def _loadProfile(self, fresh=False):
+        """Return (user Profile, created); a Profile created for a new
+        user is not written yet. The Profile is read once per request
+        unless fresh is set."""
         # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        user_id = self._getUserId()
+        context = currentRequest()
+        profile = context.profileAsync(fresh).get_result()
         # create new Profile if not there
         if not profile:
+            user = context.user()
             profile = Profile(
-                key = p_key,
+                key = ndb.Key(Profile, user_id),
                 displayName = user.nickname(),
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
                 sessionWishlist = [],
             )
-            profile.put()
+            context.setProfile(profile)
+            return profile, True
 
-        return profile      # return Profile
+        return profile, False
 
 
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
-        prof = self._getProfileFromUser()
+        prof, created = self._loadProfile()
 
-        # if saveProfile(), process user-modifyable fields
+        # if saveProfile(), process user-modifyable fields, noting
+        # which ones actually change
+        dirty = set()
         if save_request:
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
-                    if val:
+                    if val and getattr(prof, field) != str(val):
                         setattr(prof, field, str(val))
-                        prof.put()
+                        dirty.add(field)
+
+        # write at most once, and only if something changed
+        if created or dirty:
+            prof.put()
+        if 'displayName' in dirty:
+            _organiserNames.delete(prof.key.id())
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -435,6 +764,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @instrumented
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
@@ -442,6 +772,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @instrumented
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -450,60 +781,154 @@ class ConferenceApi(remote.Service):
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
+    def _setAnnouncement(names):
+        """Format Announcement for the given conference names & assign
+        to memcache."""
+        if names:
             # If there are almost sold out conferences,
             # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+            announcement = ANNOUNCEMENT_TPL % (', '.join(sorted(names)))
         else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
+            # If there are no sold out conferences, cache that too so
+            # that a memcache miss means the entry was evicted
             announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
+        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
         return announcement
 
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @staticmethod
+    def _nearlySoldOutKey():
+        """Return the key of the single NearlySoldOut entity."""
+        return ndb.Key(NearlySoldOut, 'nearlySoldOut')
+
+
+    @staticmethod
+    def _updateNearlySoldOut(conf, seatsBefore, nameBefore=None):
+        """Re-check conf in NearlySoldOut if its seatsAvailable has
+        entered or left the nearly sold out band, or it was renamed while
+        in it; when in a transaction, only if it commits."""
+        nearly = lambda seats: 0 < seats <= NEARLY_SOLD_OUT_SEATS
+        renamed = nameBefore not in (None, conf.name)
+        if nearly(seatsBefore) == nearly(conf.seatsAvailable) and \
+                not (renamed and nearly(conf.seatsAvailable)):
+            return
+
+        # in a task rather than in (or right after) the caller's
+        # transaction: registrations for different conferences don't all
+        # contend on NearlySoldOut, and contention there can't fail a
+        # registration that has already committed; the cron catches up
+        # with anything the task misses
+        taskqueue.add(params={'websafeConfKey': conf.key.urlsafe()},
+            url='/tasks/reconcile_nearly_sold_out',
+            transactional=ndb.in_transaction()
+        )
+
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _reconcileNearlySoldOut(c_keys):
+        """Re-read the given conferences and add them to or remove them
+        from NearlySoldOut by their current seatsAvailable, refreshing
+        the Announcement after commit if it changed; return the names."""
+        nso_key = ConferenceApi._nearlySoldOutKey()
+        entities = ndb.get_multi([nso_key] + list(c_keys))
+        nso = entities[0] or NearlySoldOut(key=nso_key)
+        names = dict(nso.conferenceNames or {})
+        for c_key, conf in zip(c_keys, entities[1:]):
+            if conf and 0 < conf.seatsAvailable <= NEARLY_SOLD_OUT_SEATS:
+                names[c_key.urlsafe()] = conf.name
+            else:
+                names.pop(c_key.urlsafe(), None)
+
+        if names != nso.conferenceNames:
+            nso.conferenceNames = names
+            nso.put()
+            ndb.get_context().call_on_commit(
+                lambda: ConferenceApi._setAnnouncement(names.values()))
+        return names
+
+
+    @staticmethod
+    def _cacheAnnouncement():
+        """Create Announcement & assign to memcache; used by
+        memcache cron job & putAnnouncement(). Registrations keep the
+        NearlySoldOut set current, this reconciles it with a full scan.
+        """
+        c_keys = set(Conference.query(ndb.AND(
+            Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
+            Conference.seatsAvailable > 0)
+        ).fetch(keys_only=True))
+        # the query is eventually consistent: re-check every match and
+        # every listed conference in transactions instead of overwriting
+        # what registrations have written meanwhile
+        nso = ConferenceApi._nearlySoldOutKey().get()
+        if nso and nso.conferenceNames:
+            c_keys.update(ndb.Key(urlsafe=wsck) for wsck in nso.conferenceNames)
+        c_keys = list(c_keys)
+
+        names = nso.conferenceNames if nso else None
+        for i in range(0, len(c_keys), NEARLY_SOLD_OUT_BATCH):
+            names = ConferenceApi._reconcileNearlySoldOut(
+                c_keys[i:i + NEARLY_SOLD_OUT_BATCH])
+        return ConferenceApi._setAnnouncement((names or {}).values())
+
+
+    @endpoints.method(CONDITIONAL_GET_REQUEST, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
+    @instrumented
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if announcement is None:
+            # evicted; rebuild it from the NearlySoldOut set
+            nso = self._nearlySoldOutKey().get()
+            announcement = self._setAnnouncement(
+                nso.conferenceNames.values() if nso and nso.conferenceNames else [])
+
+        etag = self._etag(announcement)
+        if request.ifNoneMatch == etag:
+            return StringMessage(data="", etag=etag, notModified=True)
+        return StringMessage(data=announcement, etag=etag)
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser() # get user Profile
-
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        
+
         try:
             conf = ndb.Key(urlsafe=wsck).get()
         except ProtocolBufferDecodeError:
             print('No conference found with key: %s' % wsck)
             raise
 
+        if conf.seatShards:
+            return self._shardedConferenceRegistration(conf, reg)
+        return self._unshardedConferenceRegistration(request, reg)
+
+
+    @ndb.transactional(xg=True)
+    def _unshardedConferenceRegistration(self, request, reg=True):
+        """Register or unregister user, keeping seat count on Conference."""
+        retval = None
+        prof = self._getProfileFromUser(fresh=True) # get user Profile
+
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        conf, attendee = ndb.get_multi(
+            [c_key, self._attendeeKey(c_key, prof.key.id())])
+
+        # registrations are kept as keys from the first write on
+        self._migrateRegistrations(prof)
+
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if c_key in prof.conferencesToAttend:
                 raise ConflictException(
                     "You have already registered for this conference")
 
@@ -513,55 +938,257 @@ class ConferenceApi(remote.Service):
                     "There are no seats available.")
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
+            prof.conferencesToAttend.append(c_key)
+            seatsBefore = conf.seatsAvailable
             conf.seatsAvailable -= 1
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if c_key in prof.conferencesToAttend:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
+                prof.conferencesToAttend.remove(c_key)
+                seatsBefore = conf.seatsAvailable
                 conf.seatsAvailable += 1
                 retval = True
             else:
                 retval = False
 
         # write things back to the datastore & return
+        if retval:
+            self._updateRoster(conf, c_key, prof.key.id(), attendee, reg)
         prof.put()
         conf.put()
+        currentRequest().setProfile(prof)
+        if retval:
+            self._updateNearlySoldOut(conf, seatsBefore)
+        self._invalidateConferenceCache(wsck)
         return BooleanMessage(data=retval)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    def _shardedConferenceRegistration(self, conf, reg=True):
+        """Register or unregister user, taking or giving back a seat on
+        one counter shard instead of rewriting the Conference entity."""
+        prof = self._getProfileFromUser() # get user Profile
+        wsck = conf.key.urlsafe()
+
+        # register
+        if reg:
+            # check if user already registered otherwise add
+            if conf.key in self._getRegistrations(prof):
+                raise ConflictException(
+                    "You have already registered for this conference")
+
+            # try the shards that still look to have seats, in random
+            # order; every attempt re-checks its shard in a transaction,
+            # so a shard never drops below zero and seats can't oversell
+            shards = [shard for shard in ndb.get_multi(self._seatShardKeys(conf))
+                      if shard and shard.seatsAvailable > 0]
+            random.shuffle(shards)
+            for shard in shards:
+                if self._moveSeat(prof.key, shard.key, wsck, reg=True):
+                    break
+            else:
+                raise ConflictException(
+                    "There are no seats available.")
+            retval = True
+
+        # unregister, giving the seat back to any shard
+        else:
+            s_key = random.choice(self._seatShardKeys(conf))
+            retval = self._moveSeat(prof.key, s_key, wsck, reg=False)
+
+        if retval:
+            self._invalidateConferenceCache(wsck)
+        self._scheduleSeatSync(wsck)
+        return BooleanMessage(data=retval)
+
+
+    @ndb.transactional(xg=True)
+    def _moveSeat(self, p_key, s_key, wsck, reg=True):
+        """Move one seat between a shard and the user's Profile; return
+        False if nothing was changed."""
+        c_key = ndb.Key(urlsafe=wsck)
+        prof, shard, attendee = ndb.get_multi(
+            [p_key, s_key, self._attendeeKey(c_key, p_key.id())])
+
+        self._migrateRegistrations(prof)
+        if reg:
+            if c_key in prof.conferencesToAttend:
+                raise ConflictException(
+                    "You have already registered for this conference")
+            if shard.seatsAvailable <= 0:
+                return False
+            prof.conferencesToAttend.append(c_key)
+            shard.seatsAvailable -= 1
+        else:
+            if c_key not in prof.conferencesToAttend:
+                return False
+            prof.conferencesToAttend.remove(c_key)
+            shard.seatsAvailable += 1
+
+        self._updateRoster(shard, c_key, p_key.id(), attendee, reg)
+        ndb.put_multi([prof, shard])
+        currentRequest().setProfile(prof)
+        return True
+
+
+    @staticmethod
+    def _seatShardKeys(conf):
+        """Return the keys of all seat counter shards of a conference."""
+        wsck = conf.key.urlsafe()
+        return [ndb.Key(SeatShard, '%s-%d' % (wsck, i))
+                for i in range(conf.seatShards)]
+
+
+    def _createSeatShards(self, conf):
+        """Split seatsAvailable of a new conference over its shards."""
+        keys = self._seatShardKeys(conf)
+        seats, extra = divmod(conf.seatsAvailable, len(keys))
+        return [SeatShard(key=s_key, conference=conf.key,
+                          seatsAvailable=seats + (1 if i < extra else 0))
+                for i, s_key in enumerate(keys)]
+
+
+    @staticmethod
+    def _getSeatsAvailable(conf):
+        """Return seats available, summing the shards of sharded confs."""
+        return ConferenceApi._getSeatsAvailableAsync(conf).get_result()
+
+
+    @staticmethod
+    @ndb.tasklet
+    def _getSeatsAvailableAsync(conf):
+        """Async version of _getSeatsAvailable."""
+        if not conf.seatShards:
+            raise ndb.Return(conf.seatsAvailable)
+        shards = yield ndb.get_multi_async(ConferenceApi._seatShardKeys(conf))
+        raise ndb.Return(sum(shard.seatsAvailable for shard in shards if shard))
+
+
+    @staticmethod
+    def _scheduleSeatSync(wsck):
+        """Enqueue a seatsAvailable sync, at most one pending per conf."""
+        # the flag expires eventually in case the task could not be added
+        if memcache.add(MEMCACHE_SEAT_SYNC_PREFIX + wsck, 1,
+                        time=SEAT_SYNC_DELAY * 6):
+            taskqueue.add(params={'websafeConfKey': wsck},
+                url='/tasks/sync_seats_available',
+                countdown=SEAT_SYNC_DELAY
+            )
+
+
+    @staticmethod
+    def _syncSeatsAvailable(websafeConfKey):
+        """Copy the summed shard count onto Conference.seatsAvailable so
+        that seat based queries keep working for sharded conferences."""
+        # clear the pending flag first: anything registered after this
+        # point schedules a new sync, anything before is in the sum below
+        memcache.delete(MEMCACHE_SEAT_SYNC_PREFIX + websafeConfKey)
+
+        c_key = ndb.Key(urlsafe=websafeConfKey)
+        conf = c_key.get()
+        if not conf or not conf.seatShards:
+            return
+        seats = ConferenceApi._getSeatsAvailable(conf)
+
+        def _update():
+            conf = c_key.get()
+            if conf.seatsAvailable != seats:
+                seatsBefore = conf.seatsAvailable
+                conf.seatsAvailable = seats
+                conf.put()
+                ConferenceApi._updateNearlySoldOut(conf, seatsBefore)
+        ndb.transaction(_update)
+
+
+    @endpoints.method(CONF_ATTENDING_GET_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @instrumented
     def getConferencesToAttend(self, request):
-        """Get list of conferences that user has registered for."""
+        """Get conferences that user has registered for, one page at a
+        time; registrations of deleted conferences are skipped and
+        listed in missing."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        keys = self._getRegistrations(prof)
+        page_size = self._getPageSize(request)
+
+        # page tokens are offset.version; offsets into a registration
+        # list that has changed since would skip or repeat conferences
+        version = self._etag(*[key.urlsafe() for key in keys])[:8]
+        offset = 0
+        if request.pageToken:
+            try:
+                offset, tokenVersion = request.pageToken.split('.')
+                offset = int(offset)
+            except ValueError:
+                raise endpoints.BadRequestException("Invalid pageToken.")
+            if tokenVersion != version:
+                raise endpoints.BadRequestException(
+                    "Registrations have changed, start again from the "
+                    "first page.")
+        end = offset + page_size
+        nextPageToken = '%d.%s' % (end, version) if end < len(keys) else None
+
+        # read the page in batches; each batch's organiser names are
+        # looked up as soon as it lands and the page is known to be
+        # needed: right away without ifNoneMatch, else on an etag mismatch
+        keys = keys[offset:end]
+        render = ndb.Future()
+        if not request.ifNoneMatch:
+            render.set_result(True)
+        confBatches = [ndb.get_multi_async(keys[i:i + ATTENDING_BATCH_SIZE])
+                       for i in range(0, len(keys), ATTENDING_BATCH_SIZE)]
+        nameBatches = [self._getBatchOrganiserNamesAsync(batch, render)
+                       for batch in confBatches]
+        conferences = [future.get_result()
+                       for batch in confBatches for future in batch]
+        missing = [key.urlsafe() for key, conf in zip(keys, conferences)
+                   if not conf]
+        conferences = [conf for conf in conferences if conf]
+
+        # version the page by the conferences' update stamps; if the
+        # client has it already, skip the organiser lookups and conversion
+        etag = self._etag(offset, nextPageToken, *[
+            (conf.key.urlsafe(), conf.updated) for conf in conferences])
+        if request.ifNoneMatch == etag:
+            render.set_result(False)
+            return ConferenceForms(etag=etag, notModified=True)
+        if not render.done():
+            render.set_result(True)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
+        names = {}
+        for batch in nameBatches:
+            names.update(batch.get_result())
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+                   for conf in conferences],
+            nextPageToken=nextPageToken,
+            etag=etag,
+            missing=missing,
         )
 
 
+    @ndb.tasklet
+    def _getBatchOrganiserNamesAsync(self, confFutures, render):
+        """Return {user id: displayName} of the organisers of a batch of
+        conferences once it has landed, if render resolves to True."""
+        conferences = yield confFutures
+        names = {}
+        if (yield render):
+            names = yield self._getOrganiserNamesAsync(
+                conf.organizerUserId for conf in conferences if conf)
+        raise ndb.Return(names)
+
+
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @instrumented
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -570,14 +1197,276 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @instrumented
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
 
 
+# - - - Registration keys - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _getRegistrations(prof):
+        """Return the keys of the conferences a user registered for,
+        including any still stored as websafe strings."""
+        keys = list(prof.conferencesToAttend)
+        seen = set(keys)
+        for wsck in prof.conferenceKeysToAttend:
+            key = ndb.Key(urlsafe=wsck)
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+        return keys
+
+
+    @staticmethod
+    def _migrateRegistrations(prof):
+        """Move registrations stored as websafe strings onto
+        conferencesToAttend; return whether prof changed."""
+        if not prof.conferenceKeysToAttend:
+            return False
+        prof.conferencesToAttend = ConferenceApi._getRegistrations(prof)
+        prof.conferenceKeysToAttend = []
+        return True
+
+
+    @staticmethod
+    def _scheduleRegistrationMigration():
+        """Start migrating registrations stored as websafe strings, unless
+        a migration is running."""
+        if memcache.add(MEMCACHE_MIGRATION_KEY, 1, time=MIGRATION_TTL):
+            taskqueue.add(url='/tasks/migrate_registrations')
+
+
+    @staticmethod
+    def _migrateRegistrationBatch(cursor=None):
+        """Migrate one batch of Profiles still holding websafe strings in a
+        single transaction, then chain a task for the next batch.
+
+        Migrated Profiles drop out of the query, so a chain that stopped
+        is simply started again by the cron job.
+        """
+        p_keys, next_cursor, more = Profile.query(
+            Profile.conferenceKeysToAttend > '').fetch_page(
+            MIGRATION_BATCH, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+        def _migrate():
+            profiles = [prof for prof in ndb.get_multi(p_keys)
+                        if prof and ConferenceApi._migrateRegistrations(prof)]
+            ndb.put_multi(profiles)
+        if p_keys:
+            ndb.transaction(_migrate, xg=True)
+
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                url='/tasks/migrate_registrations'
+            )
+        else:
+            memcache.delete(MEMCACHE_MIGRATION_KEY)
+
+
+# - - - Backfills - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _backfillDone(name):
+        """Return whether every entity of a backfill has been re-put."""
+        if name not in _backfillsDone:
+            state = ndb.Key(Backfill, name).get()
+            if not (state and state.done):
+                return False
+            _backfillsDone.add(name)
+        return True
+
+
+    @staticmethod
+    def _scheduleBackfills():
+        """Start the backfills that have not finished, one chain of tasks
+        per backfill at a time."""
+        for name in BACKFILLS:
+            if not ConferenceApi._backfillDone(name) and memcache.add(
+                    MEMCACHE_BACKFILL_PREFIX + name, 1, time=BACKFILL_TTL):
+                taskqueue.add(params={'name': name}, url='/tasks/backfill')
+
+
+    @staticmethod
+    def _backfillBatch(name):
+        """Re-put one batch of a backfill's entities in a transaction, so
+        properties added since they were written get stored; then chain
+        a task for the next batch or record that the backfill is done.
+
+        The cursor is kept on the Backfill, so a chain that stopped
+        resumes where it left off when the cron job starts it again.
+        """
+        b_key = ndb.Key(Backfill, name)
+        state = b_key.get() or Backfill(key=b_key)
+        if state.done:
+            return
+
+        keys, next_cursor, more = BACKFILLS[name].query().fetch_page(
+            BACKFILL_BATCH, keys_only=True,
+            start_cursor=Cursor(urlsafe=state.cursor) if state.cursor else None)
+
+        def _reput():
+            ndb.put_multi([entity for entity in ndb.get_multi(keys) if entity])
+        if keys:
+            ndb.transaction(_reput, xg=True)
+
+        state.cursor = next_cursor.urlsafe() if more and next_cursor else None
+        state.done = state.cursor is None
+        state.put()
+        if state.done:
+            memcache.delete(MEMCACHE_BACKFILL_PREFIX + name)
+        else:
+            taskqueue.add(params={'name': name}, url='/tasks/backfill')
+
+
+# - - - Attendee roster - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _attendeeKey(c_key, user_id):
+        """Return the key of a user's Attendee for a conference."""
+        return ndb.Key(Attendee, '%s|%s' % (c_key.urlsafe(), user_id))
+
+
+    @staticmethod
+    def _updateRoster(counter, c_key, user_id, attendee, reg=True):
+        """Add or remove a user's Attendee (as read in the registration
+        transaction) and count it on counter, the Conference or one of its
+        seat shards; the caller writes counter. Return whether anything
+        changed."""
+        a_key = ConferenceApi._attendeeKey(c_key, user_id)
+        if reg and not attendee:
+            Attendee(key=a_key, conference=c_key, userId=user_id).put()
+            counter.attendees += 1
+        elif not reg and attendee:
+            a_key.delete()
+            counter.attendees -= 1
+        else:
+            return False
+        return True
+
+
+    @staticmethod
+    def _scheduleRosterIndex(wsck):
+        """Enqueue indexing of registrations made before the conference
+        had a roster, at most one chain of tasks at a time."""
+        if memcache.add(MEMCACHE_ROSTER_INDEX_PREFIX + wsck, 1,
+                        time=ROSTER_INDEX_TTL):
+            taskqueue.add(params={'websafeConfKey': wsck},
+                url='/tasks/index_roster'
+            )
+
+
+    @staticmethod
+    def _indexRoster(websafeConfKey, cursor=None):
+        """Add Attendees for one batch of users registered before the
+        conference had a roster, then chain a task for the next batch or
+        mark the roster complete."""
+        c_key = ndb.Key(urlsafe=websafeConfKey)
+        conf = c_key.get()
+        if not conf or conf.rosterIndexed:
+            return
+
+        p_keys, next_cursor, more = Profile.query(ndb.OR(
+            Profile.conferencesToAttend == c_key,
+            Profile.conferenceKeysToAttend == websafeConfKey)).order(
+            Profile.key).fetch_page(
+            ROSTER_INDEX_BATCH, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        counters = ConferenceApi._seatShardKeys(conf) or [c_key]
+        for p_key in p_keys:
+            ConferenceApi._indexAttendee(c_key, p_key, random.choice(counters))
+
+        if more and next_cursor:
+            taskqueue.add(params={'websafeConfKey': websafeConfKey,
+                                  'cursor': next_cursor.urlsafe()},
+                url='/tasks/index_roster'
+            )
+            return
+
+        def _complete():
+            conf = c_key.get()
+            conf.rosterIndexed = True
+            conf.put()
+        ndb.transaction(_complete)
+        memcache.delete(MEMCACHE_ROSTER_INDEX_PREFIX + websafeConfKey)
+
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _indexAttendee(c_key, p_key, counter_key):
+        """Add the Attendee of a user if they are (still) registered."""
+        a_key = ConferenceApi._attendeeKey(c_key, p_key.id())
+        prof, attendee, counter = ndb.get_multi([p_key, a_key, counter_key])
+        if prof and c_key in ConferenceApi._getRegistrations(prof):
+            if ConferenceApi._updateRoster(counter, c_key, p_key.id(), attendee):
+                counter.put()
+
+
+    def _getOwnConference(self, wsck):
+        """Return a conference organised by the current user; start
+        indexing its roster if that was never done."""
+        user_id = self._getUserId()
+        try:
+            conf = ndb.Key(urlsafe=wsck).get()
+        except ProtocolBufferDecodeError:
+            print('No conference found with key: %s' % wsck)
+            raise
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can see the attendees.')
+        if not conf.rosterIndexed:
+            self._scheduleRosterIndex(wsck)
+        return conf
+
+
+    @endpoints.method(CONF_ATTENDEES_GET_REQUEST, AttendeeForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    @instrumented
+    def getConferenceAttendees(self, request):
+        """Return users registered for a conference, one page at a time
+        (organiser only)."""
+        conf = self._getOwnConference(request.websafeConferenceKey)
+        page_size, cursor = self._getPageParams(request)
+        attendees, next_cursor, more = Attendee.query(
+            Attendee.conference == conf.key).fetch_page(
+            page_size, start_cursor=cursor)
+
+        names = self._getOrganiserNamesAsync(
+            attendee.userId for attendee in attendees).get_result()
+        return AttendeeForms(
+            items=[copyToForm(attendee, AttendeeForm,
+                              displayName=names.get(attendee.userId))
+                   for attendee in attendees],
+            nextPageToken=next_cursor.urlsafe() if more and next_cursor else None,
+            complete=conf.rosterIndexed,
+        )
+
+
+    @endpoints.method(CONF_GET_REQUEST, AttendeeCountForm,
+            path='conference/{websafeConferenceKey}/attendees/count',
+            http_method='GET', name='getConferenceAttendeeCount')
+    @instrumented
+    def getConferenceAttendeeCount(self, request):
+        """Return the number of users registered for a conference
+        (organiser only)."""
+        conf = self._getOwnConference(request.websafeConferenceKey)
+        count = conf.attendees
+        if conf.seatShards:
+            shards = ndb.get_multi(self._seatShardKeys(conf))
+            count += sum(shard.attendees for shard in shards if shard)
+        return AttendeeCountForm(count=count, complete=conf.rosterIndexed)
+
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
+    @instrumented
     def filterPlayground(self, request):
         """Filter Playground"""
         q = Conference.query()
@@ -585,32 +1474,23 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.topics == "Medical Innovations")
         q = q.filter(Conference.month == 6)
 
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
-        )
+        return self._copyConferencesToForms(q)
 
 # - - - Speakers - - - - - - - - - - - - - - - - - - - - - - - - -
     def _copySpeakerToForm(self, speaker):
         """Copy relevant fields from Speaker to SpeakerForm."""
-        sf = SpeakerForm()
-        for field in sf.all_fields():
-            if hasattr(speaker, field.name):
-                setattr(sf, field.name, getattr(speaker, field.name))
-        sf.check_initialized()
-        return sf
+        return copyToForm(speaker, SpeakerForm)
 
-    def _getSpeaker(self, name, email):
-        """Return Speaker from datastore, creating new one if non-existent."""
-        # get Speaker from datastore
-        s_key = ndb.Key(Speaker, email)
-        speaker = s_key.get()
+    def _checkSpeaker(self, speaker, name, email):
+        """Return Speaker fetched for email, or a new (unsaved) one if
+        non-existent; raise if the email belongs to somebody else."""
         # create new Speaker if not there
         if not speaker:
             speaker = Speaker(
-                key = s_key,
+                key = ndb.Key(Speaker, email),
                 name = name,
-                email= email)
-            speaker.put()
+                email= email,
+                sessionsIndexed = True)
         else:
             #check name is the same, else return error 
             if speaker.name != name:
@@ -619,16 +1499,41 @@ class ConferenceApi(remote.Service):
 
         return speaker      # return Speaker
 
-    @endpoints.method(message_types.VoidMessage, SpeakerForms,
+    @ndb.transactional_tasklet
+    def _addSessionsToSpeakerAsync(self, speaker, session_keys, indexed=False):
+        """Store speaker (if new) with session_keys added to its sessions;
+        indexed marks that all its older sessions are included too."""
+        stored = yield speaker.key.get_async()
+        speaker = stored or speaker
+        known = set(speaker.sessionKeys)
+        speaker.sessionKeys.extend(key for key in session_keys if key not in known)
+        if indexed:
+            speaker.sessionsIndexed = True
+        yield speaker.put_async()
+        raise ndb.Return(speaker)
+
+    @endpoints.method(SPEAKERS_GET_REQUEST, SpeakerForms,
             path='getSpeakers',
             http_method='GET',
             name='getSpeakers')
+    @instrumented
     def getSpeakers(self, request):
-        """Query for speakers."""
-        speakers = Speaker.query()
+        """Query for speakers, one page at a time, optionally only those
+        whose name or email starts with prefix."""
+        page_size, cursor = self._getPageParams(request)
+        if request.prefix:
+            prefix = request.prefix.lower()
+            speakers = Speaker.query(Speaker.searchTerms >= prefix,
+                                     Speaker.searchTerms < prefix + u'\ufffd')
+            speakers = speakers.order(Speaker.searchTerms)
+        else:
+            speakers = Speaker.query().order(Speaker.name)
+        speakers, next_cursor, more = speakers.fetch_page(
+            page_size, start_cursor=cursor)
 
         return SpeakerForms(
-                items=[self._copySpeakerToForm(speaker) for speaker in speakers]
+                items=[self._copySpeakerToForm(speaker) for speaker in speakers],
+                nextPageToken=next_cursor.urlsafe() if more and next_cursor else None
         )
 
 
@@ -636,6 +1541,7 @@ class ConferenceApi(remote.Service):
             path='speaker/detail/{speakerId}',
             http_method='GET',
             name='getSpeakerDetails')
+    @instrumented
     def getSpeakerDetails(self, request):
         """Get details of a certain speaker"""
         s_key = ndb.Key(Speaker, request.speakerId)
@@ -647,192 +1553,450 @@ class ConferenceApi(remote.Service):
 
     def _copySessionToForm(self, session):
         """Copy relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(session, field.name):
-                # convert Date to date string; just copy others
-                if field.name == "date":
-                    setattr(sf, field.name, str(getattr(session, field.name)))
-                elif field.name == "startTime":
-                    stime = getattr(session, field.name)
-                    if stime:
-                        setattr(sf, field.name, stime.strftime('%H:%M'))
-                    else:
-                        setattr(sf, field.name, 'N/A')
-                else:
-                    setattr(sf, field.name, getattr(session, field.name))
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, session.key.urlsafe())
-        sf.check_initialized()
-        return sf
+        return copyToForm(session, SessionForm)
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+    @staticmethod
+    def _cacheSessionForms(forms):
+        """Put rendered SessionForms in memcache, by websafe key."""
+        memcache.set_multi(dict((sf.websafeKey, protojson.encode_message(sf))
+                                for sf in forms),
+                           key_prefix=MEMCACHE_SESSION_PREFIX,
+                           time=SESSION_CACHE_TTL)
+
+    def _getSessionForms(self, keys):
+        """Return (SessionForms, keys of missing sessions) for session
+        keys; rendered forms come from memcache where cached."""
+        wssks = [key.urlsafe() for key in keys]
+        cached = memcache.get_multi(wssks, key_prefix=MEMCACHE_SESSION_PREFIX)
+        missing = [key for key, wssk in zip(keys, wssks) if wssk not in cached]
+        self._countCacheLookup('session', True, len(keys) - len(missing))
+        self._countCacheLookup('session', False, len(missing))
+
+        # cached forms are dropped when their session is deleted, so only
+        # the misses need to be read
+        forms = dict((wssk, protojson.decode_message(SessionForm, data))
+                     for wssk, data in cached.iteritems())
+        rendered = [self._copySessionToForm(session)
+                    for session in ndb.get_multi(missing) if session]
+        self._cacheSessionForms(rendered)
+        forms.update((sf.websafeKey, sf) for sf in rendered)
+
+        items, stale = [], []
+        for key, wssk in zip(keys, wssks):
+            if wssk in forms:
+                items.append(forms[wssk])
+            else:
+                stale.append(key)
+        return items, stale
+
+    def _copySessionFormToData(self, form):
+        """Copy SessionForm into a dict of Session data, converting date
+        and startTime; speakerName/speakerEmail are left to the caller."""
+        if not form.name:
+            raise endpoints.BadRequestException("Session 'name' field required")
+
+        # copy SessionForm/ProtoRPC Message into dict
+        data = {field.name: getattr(form, field.name) for field in form.all_fields()}
+        data.pop('websafeConferenceKey', None)
+        del data['websafeKey']
+
+        # convert date and startTime from string to Date/Time objects; 
+        if data['date']:
+            data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
+        if data['startTime']:
+            data['startTime'] = datetime.strptime(data['startTime'][:5], "%H:%M").time()
+        return data
 
     def _createSessionObject(self, request):
         """Create conference Session object, returning SessionForm/request"""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        return self._createSessionObjectAsync(request).get_result()
+
+    @ndb.tasklet
+    def _createSessionObjectAsync(self, request):
+        """Tasklet behind _createSessionObject; the conference get, speaker
+        get and id allocation run concurrently, as do all the writes."""
+        user_id = self._getUserId()
 
-        # check that conference exists
-        # and get conference details 
+        data = self._copySessionFormToData(request)
         try:
             c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-            conf = c_key.get()
         except ProtocolBufferDecodeError:
             print('No conference found with key: %s' % request.websafeConferenceKey)
             raise
-        
-        # check that user is owner
+
+        # start the independent reads: conference details, speaker
+        # and a Session ID
+        conf_future = c_key.get_async()
+        ids_future = Session.allocate_ids_async(size=1, parent=c_key)
+        speaker_future = None
+        if data['speakerName'] and data['speakerEmail']:
+            speaker_future = ndb.Key(Speaker, data['speakerEmail']).get_async()
+
+        # check that conference exists and user is owner
+        conf = yield conf_future
         if user_id != conf.organizerUserId:
             raise endpoints.ForbiddenException(
                 'Only the conference owner can add sessions.')
 
-        if not request.name:
-            raise endpoints.BadRequestException("Session 'name' field required")
-
-        # copy SessionForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        del data['websafeConferenceKey']
-
-        # convert date and startTime from string to Date/Time objects; 
-        if data['date']:
-            data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
-        if data['startTime']:
-            data['startTime'] = datetime.strptime(data['startTime'][:5], "%H:%M").time()
-
-        # Add speaker id
-        if data['speakerName'] and data['speakerEmail']:
-            speaker = self._getSpeaker(data['speakerName'], data['speakerEmail'])
+        writes = []
+        # Add speaker id, creating the speaker if needed
+        if speaker_future:
+            found = yield speaker_future
+            speaker = self._checkSpeaker(found,
+                data['speakerName'], data['speakerEmail'])
             data['speakerId'] = speaker.email
         del data['speakerName']
         del data['speakerEmail']
-        del data['websafeKey']
 
-        # # generate Session ID and key
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        s_key = ndb.Key(Session, s_id, parent=c_key)
-        data['key'] = s_key
-        
-        # create Session & return (modified) SessionForm
-        session = Session(**data)
-        session.put()
-        taskqueue.add(params={'websafeConfKey': request.websafeConferenceKey,
-            'speakerId': data['speakerId']},
-            url='/tasks/check_featured_speaker'
-        )
-        return self._copySessionToForm(session)
+        # generate Session key; store the speaker (if new) along with it
+        s_id = (yield ids_future)[0]
+        data['key'] = ndb.Key(Session, s_id, parent=c_key)
+        if speaker_future:
+            writes.append(self._addSessionsToSpeakerAsync(speaker, [data['key']]))
 
-    def _getConferenceSessions(self, request):
-        """Given a conference, return a query object with its sessions"""
-        # check that conference exists and get its details
+        # create Session, add it to the speaker aggregate and only once
+        # that committed enqueue the featured speaker check; then return
+        # (modified) SessionForm
+        session = Session(**data)
+        writes.append(session.put_async())
+        yield writes
+        yield (self._addToSpeakerAggregateAsync(c_key, [session]),
+               self._invalidateScheduleAsync(c_key))
+        scheduled = self._scheduleFeaturedSpeakerCheckAsync(
+            request.websafeConferenceKey)
+        sf = self._copySessionToForm(session)
+        self._cacheSessionForms([sf])
+        yield scheduled
+        raise ndb.Return(sf)
+
+    def _importSessionObjects(self, request):
+        """Create many Sessions of one conference in a few batched RPCs,
+        returning SessionForms for the created sessions."""
+        user_id = self._getUserId()
+
+        if len(request.items) > MAX_IMPORT_SESSIONS:
+            raise endpoints.BadRequestException(
+                "At most %d sessions can be imported at once." % MAX_IMPORT_SESSIONS)
+        datas = [self._copySessionFormToData(form) for form in request.items]
+        if not datas:
+            return SessionForms(items=[])
+
+        # check that conference exists and user is owner
+        wsck = request.websafeConferenceKey
         try:
-            c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+            c_key = ndb.Key(urlsafe=wsck)
             conf = c_key.get()
         except ProtocolBufferDecodeError:
-            print('No conference found with key: %s' % request.websafeConferenceKey)
+            print('No conference found with key: %s' % wsck)
             raise
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the conference owner can add sessions.')
 
-        # get sessions
-        return Session.query(ancestor=c_key)
-        
-        
+        # dedupe speakers by email, then fetch them all at once and
+        # collect the ones that have to be created
+        speakers = {}
+        for data in datas:
+            if data['speakerName'] and data['speakerEmail']:
+                name = speakers.setdefault(data['speakerEmail'], data['speakerName'])
+                if name != data['speakerName']:
+                    raise ConflictException(
+                        "Different speakers are given with this email %s" % data['speakerEmail'])
+        emails = speakers.keys()
+        found = ndb.get_multi([ndb.Key(Speaker, email) for email in emails])
+        for email, speaker in zip(emails, found):
+            speakers[email] = self._checkSpeaker(speaker, speakers[email], email)
+
+        # one ID range for all the sessions
+        first, last = Session.allocate_ids(size=len(datas), parent=c_key)
+        sessions = []
+        speakerSessions = {}
+        for s_id, data in zip(range(first, last + 1), datas):
+            data['key'] = ndb.Key(Session, s_id, parent=c_key)
+            if data['speakerName'] and data['speakerEmail']:
+                data['speakerId'] = data['speakerEmail']
+                speakerSessions.setdefault(data['speakerId'], []).append(data['key'])
+            del data['speakerName']
+            del data['speakerEmail']
+            sessions.append(Session(**data))
+
+        # write sessions, and speakers with their new sessions, together;
+        # then add them all to the speaker aggregate and check the
+        # featured speaker once
+        writes = [self._addSessionsToSpeakerAsync(speakers[email], keys)
+                  for email, keys in speakerSessions.iteritems()]
+        writes.extend(ndb.put_multi_async(sessions))
+        ndb.Future.wait_all(writes)
+        for write in writes:
+            write.check_success()
+        writes = [self._addToSpeakerAggregateAsync(c_key, sessions),
+                  self._invalidateScheduleAsync(c_key)]
+        for write in writes:
+            write.get_result()
+        scheduled = self._scheduleFeaturedSpeakerCheckAsync(wsck)
+
+        items = [self._copySessionToForm(session) for session in sessions]
+        self._cacheSessionForms(items)
+        scheduled.get_result()
+        return SessionForms(items=items)
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @staticmethod
+    def _scheduleKey(c_key):
+        """Return the key of a conference's ConferenceSchedule."""
+        return ndb.Key(ConferenceSchedule, 'schedule', parent=c_key)
+
+
+    @ndb.transactional_tasklet
+    def _buildScheduleAsync(self, c_key):
+        """Render all sessions of a conference, by date and start time,
+        into its ConferenceSchedule."""
+        sessions = yield Session.query(ancestor=c_key).fetch_async()
+        sessions.sort(key=lambda s: (s.date, s.startTime, s.name))
+        items = [self._copySessionToForm(session) for session in sessions]
+        self._cacheSessionForms(items)
+        forms = protojson.encode_message(SessionForms(items=items))
+        schedule = ConferenceSchedule(key=self._scheduleKey(c_key),
+            forms=forms, etag=hashlib.md5(forms).hexdigest())
+        yield schedule.put_async()
+        raise ndb.Return(schedule)
+
+
+    @ndb.tasklet
+    def _invalidateScheduleAsync(self, c_key):
+        """Drop the stored and cached schedule of a conference after its
+        sessions changed; the next read rebuilds it."""
+        yield self._scheduleKey(c_key).delete_async()
+        yield ndb.get_context().memcache_delete(
+            MEMCACHE_SCHEDULE_PREFIX + c_key.urlsafe(), seconds=CACHE_FILL_LOCK)
+
+
+    def _getSchedule(self, wsck):
+        """Return (etag, SessionForms JSON) of all sessions of a
+        conference from its schedule: cached, stored or else built."""
+        return self._getScheduleAsync(wsck).get_result()
+
+
+    @ndb.tasklet
+    def _getScheduleAsync(self, wsck):
+        """Async version of _getSchedule."""
+        ctx = ndb.get_context()
+        cached = yield ctx.memcache_get(MEMCACHE_SCHEDULE_PREFIX + wsck)
+        self._countCacheLookup('schedule', cached is not None)
+        if cached is None:
+            try:
+                c_key = ndb.Key(urlsafe=wsck)
+            except ProtocolBufferDecodeError:
+                print('No conference found with key: %s' % wsck)
+                raise
+            schedule = yield self._scheduleKey(c_key).get_async()
+            if not schedule:
+                conf = yield c_key.get_async()
+                if not conf:
+                    raise endpoints.NotFoundException(
+                        'No conference found with key: %s' % wsck)
+                schedule = yield self._buildScheduleAsync(c_key)
+            cached = (schedule.etag, schedule.forms)
+            # add, so that a schedule invalidated since it was read is
+            # not cached again
+            yield ctx.memcache_add(MEMCACHE_SCHEDULE_PREFIX + wsck, cached,
+                                   time=SCHEDULE_CACHE_TTL)
+        raise ndb.Return(cached)
+
+
+    @endpoints.method(CONF_SESSIONS_GET_REQUEST, SessionForms,
             path='conference/{websafeConferenceKey}/sessions',
             http_method='GET', name='getConferenceSessions')
+    @instrumented
     def getConferenceSessions(self, request):
-        """Given a conference, return all sessions as a query object."""
-        # get sessions
-        sessions = self._getConferenceSessions(request)
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        """Given a conference, return all sessions."""
+        etag, forms = self._getSchedule(request.websafeConferenceKey)
+        if request.ifNoneMatch == etag:
+            return SessionForms(etag=etag, notModified=True)
+
+        sf = protojson.decode_message(SessionForms, forms)
+        sf.etag = etag
+        return sf
 
 
     @endpoints.method(CONF_TYPE_GET_REQUEST, SessionForms,
             path='conference/{websafeConferenceKey}/{typeOfSession}/sessions',
             http_method='GET', name='getConferenceSessionsByType')
+    @instrumented
     def getConferenceSessionsByType(self, request): 
         """Given a conference, return all sessions of a certain type"""
         # get all sessions
-        sessions = self._getConferenceSessions(request)
+        etag, forms = self._getSchedule(request.websafeConferenceKey)
+        etag = self._etag(etag, request.typeOfSession)
+        if request.ifNoneMatch == etag:
+            return SessionForms(etag=etag, notModified=True)
+
         # filter only a certain type
-        sessions = sessions.filter(Session.typeOfSession == request.typeOfSession)
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        sf = protojson.decode_message(SessionForms, forms)
+        sf.items = [session for session in sf.items
+                    if session.typeOfSession == request.typeOfSession]
+        sf.etag = etag
+        return sf
+
+
+    def _getSpeakerSessionKeys(self, speaker):
+        """Return the keys of all sessions of a speaker; speakers from
+        before sessions were recorded on them are indexed once here."""
+        if not speaker.sessionsIndexed:
+            keys = Session.query(Session.speakerId == speaker.email).fetch(keys_only=True)
+            speaker = self._addSessionsToSpeakerAsync(speaker, keys, indexed=True).get_result()
+        return speaker.sessionKeys
 
 
-    @endpoints.method(SPEAKER_GET_REQUEST, SessionForms,
+    @endpoints.method(SPEAKER_SESSIONS_GET_REQUEST, SessionForms,
             path='speaker/{speakerId}/sessions',
             http_method='GET', name='getSessionsBySpeaker')
+    @instrumented
     def getSessionsBySpeaker(self, request):
-        """Given a speaker, return all his sessions."""
-        sessions = Session.query().filter(Session.speakerId == request.speakerId)
+        """Given a speaker, return his sessions, one page at a time,
+        optionally only those of one conference."""
+        c_key = None
+        if request.websafeConferenceKey:
+            try:
+                c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+            except ProtocolBufferDecodeError:
+                print('No conference found with key: %s' % request.websafeConferenceKey)
+                raise
+
+        speaker = ndb.Key(Speaker, request.speakerId).get()
+        if not speaker:
+            # free-form speakerId without a Speaker; query for it
+            page_size, cursor = self._getPageParams(request)
+            sessions = Session.query(ancestor=c_key) if c_key else Session.query()
+            sessions = sessions.filter(Session.speakerId == request.speakerId)
+            sessions, next_cursor, more = sessions.fetch_page(
+                page_size, start_cursor=cursor)
+            return SessionForms(
+                items=[self._copySessionToForm(session) for session in sessions],
+                nextPageToken=next_cursor.urlsafe() if more and next_cursor else None
+            )
+
+        # session keys are stored on the speaker; page through them
+        keys = self._getSpeakerSessionKeys(speaker)
+        if c_key:
+            keys = [key for key in keys if key.parent() == c_key]
+        page_size = self._getPageSize(request)
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        end = offset + page_size
+
+        sessions = ndb.get_multi(keys[offset:end])
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
+            items=[self._copySessionToForm(session) for session in sessions if session],
+            nextPageToken=str(end) if end < len(keys) else None
         )
 
 
     @endpoints.method(SESSION_POST_REQUEST, SessionForm, 
             path='/conference/{websafeConferenceKey}/session',
             http_method='POST', name='createSession')
+    @instrumented
     def createSession(self, request): 
         """Open only to the organizer of the conference"""
         return self._createSessionObject(request)
 
 
+    @endpoints.method(SESSIONS_POST_REQUEST, SessionForms,
+            path='/conference/{websafeConferenceKey}/sessions/import',
+            http_method='POST', name='importSessions')
+    @instrumented
+    def importSessions(self, request):
+        """Create many sessions at once; open only to the organizer."""
+        return self._importSessionObjects(request)
+
+
+
+    @staticmethod
+    def _wishlistEntryKey(p_key, s_key):
+        """Return the key of the WishlistEntry of a session."""
+        return ndb.Key(WishlistEntry, s_key.urlsafe(), parent=p_key)
+
+
+    def _getWishlistKeys(self, prof):
+        """Return the session keys on a user's wishlist, in the order they
+        were added; includes any still stored on the Profile itself."""
+        entries = WishlistEntry.query(ancestor=prof.key).order(
+            WishlistEntry.added).fetch(keys_only=True)
+        return prof.sessionWishlist + [ndb.Key(urlsafe=key.id()) for key in entries]
+
+
+    def _getSessionKeys(self, websafeKeys):
+        """Return distinct session Keys for websafe keys, checking that
+        all the sessions exist."""
+        keys = []
+        seen = set()
+        for wssk in websafeKeys:
+            try:
+                key = ndb.Key(urlsafe=wssk)
+            except ProtocolBufferDecodeError:
+                print('No session found with key: %s' % wssk)
+                raise
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+        for key, session in zip(keys, ndb.get_multi(keys)):
+            if not session or key.kind() != 'Session':
+                raise endpoints.NotFoundException(
+                    'No session found with key: %s' % key.urlsafe())
+        return keys
+
+
+    def _updateWishlist(self, prof, add=(), remove=()):
+        """Add and remove sessions on a user's wishlist, writing only one
+        small WishlistEntry per change; return (added, removed) keys."""
+        add, remove = list(add), list(remove)
+
+        # sessions still stored on the Profile are moved to entries
+        legacy = prof.sessionWishlist
+        listed = set(self._wishlistEntryKey(prof.key, key) for key in legacy)
+
+        # check membership by key; one batch get for all sessions
+        e_keys = [self._wishlistEntryKey(prof.key, key) for key in add + remove]
+        listed.update(entry.key for entry in ndb.get_multi(e_keys) if entry)
+        added = [key for key, e_key in zip(add, e_keys) if e_key not in listed]
+        removed = [key for key, e_key in zip(remove, e_keys[len(add):]) if e_key in listed]
+
+        deletes = set(self._wishlistEntryKey(prof.key, key) for key in removed)
+        puts = set(self._wishlistEntryKey(prof.key, key) for key in legacy + added)
+        futures = ndb.put_multi_async(
+            [WishlistEntry(key=e_key) for e_key in puts - deletes])
+        futures.extend(ndb.delete_multi_async(list(deletes)))
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+
+        if legacy:
+            prof.sessionWishlist = []
+            prof.put()
+        return added, removed
+
 
     def _updateSessionWishlist(self, request, add=True):
         """Add or remove session to/from wishlist"""
         prof = self._getProfileFromUser() # get user Profile
         
         # check if session exists given key and get it
-        try:
-            sessionKey = ndb.Key(urlsafe=request.sessionKey)
-            session = sessionKey.get()
-        except ProtocolBufferDecodeError:
-            print('No session found with key: %s' % request.sessionKey)
-            raise
+        sessionKeys = self._getSessionKeys([request.sessionKey])
 
         # add session
         if add:
             # check if session already added to wihslist, otherwise add
-            if sessionKey in prof.sessionWishlist:
+            added, removed = self._updateWishlist(prof, add=sessionKeys)
+            if not added:
                 raise ConflictException(
                     "You already added this session to your wishlist")
-
-            prof.sessionWishlist.append(sessionKey)
             retval = True
 
-        # remove session
+        # remove session, if it is in wishlist
         else:
-            # check if session is in wishlist, if so remove
-            if sessionKey in prof.sessionWishlist:
-                prof.sessionWishlist.remove(sessionKey)
-                retval = True
-            else:
-                retval = False
-
-        # write profile back to datastore
-        prof.put()
+            added, removed = self._updateWishlist(prof, remove=sessionKeys)
+            retval = bool(removed)
 
         return BooleanMessage(data=retval)
 
@@ -841,6 +2005,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(WISHLIST_POST_REQUEST, BooleanMessage,
             path='conference/session/addToWishlist',
             http_method='POST', name='addToWishlist')
+    @instrumented
     def addToWishlist(self, request):
         """Add session to wishlist."""
         return self._updateSessionWishlist(request)
@@ -849,66 +2014,209 @@ class ConferenceApi(remote.Service):
     @endpoints.method(WISHLIST_POST_REQUEST, BooleanMessage,
             path='conference/session/removeFromWishlist',
             http_method='DELETE', name='removeFromWishlist')
+    @instrumented
     def removeFromWishlist(self, request):
         """Remove session from wishlist."""
         return self._updateSessionWishlist(request, False)
 
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(WishlistForm, WishlistForm,
+            path='conference/session/updateWishlist',
+            http_method='POST', name='updateWishlist')
+    @instrumented
+    def updateWishlist(self, request):
+        """Add and remove many sessions to/from wishlist at once; return
+        the sessions actually added and removed."""
+        if set(request.add) & set(request.remove):
+            raise endpoints.BadRequestException(
+                "A session can't be both added and removed.")
+        prof = self._getProfileFromUser() # get user Profile
+        added, removed = self._updateWishlist(prof,
+            add=self._getSessionKeys(request.add),
+            remove=self._getSessionKeys(request.remove))
+        return WishlistForm(add=[key.urlsafe() for key in added],
+                            remove=[key.urlsafe() for key in removed])
+
+
+    @endpoints.method(CONDITIONAL_GET_REQUEST, SessionForms,
             path='getSessionsInWishlist', http_method='GET',
             name='getSessionsInWishlist')
+    @instrumented
     def getSessionsInWishlist(self, request):
         """Get all the sessions from the current user's wishlist."""
         prof = self._getProfileFromUser() # get user Profile
-        sessions = ndb.get_multi(prof.sessionWishlist)
+        wishlist = self._getWishlistKeys(prof)
+
+        # sessions are not edited, so the wishlist keys version the list
+        etag = self._etag(*[key.urlsafe() for key in wishlist])
+        if request.ifNoneMatch == etag:
+            return SessionForms(etag=etag, notModified=True)
+
+        # skip sessions that no longer exist and prune them in a task
+        items, stale = self._getSessionForms(wishlist)
+        if stale:
+            taskqueue.add(params={'userId': prof.key.id(),
+                'sessionKey': [key.urlsafe() for key in stale]},
+                url='/tasks/prune_wishlist'
+            )
+        return SessionForms(items=items, etag=etag)
 
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+
+    @staticmethod
+    def _pruneWishlist(user_id, websafeKeys):
+        """Remove sessions that no longer exist from a user's wishlist."""
+        p_key = ndb.Key(Profile, user_id)
+        keys = [ndb.Key(urlsafe=wssk) for wssk in websafeKeys]
+        keys = [key for key, session in zip(keys, ndb.get_multi(keys)) if not session]
+        if not keys:
+            return
+
+        ndb.delete_multi([ConferenceApi._wishlistEntryKey(p_key, key) for key in keys])
+
+        def _update():
+            prof = p_key.get()
+            if prof and set(keys) & set(prof.sessionWishlist):
+                prof.sessionWishlist = [key for key in prof.sessionWishlist
+                                        if key not in keys]
+                prof.put()
+        ndb.transaction(_update)
           
 
+# - - - Featured speaker - - - - - - - - - - - - - - - - - - - -
+
     @staticmethod
-    def _checkFeaturedSpeaker(websafeConfKey, speakerId):
-        """Check if speaker should be featured (has more sessions
-            in conf). If so, add to memcache with sessions"""
+    def _speakerAggregateKey(c_key):
+        """Return the key of a conference's ConferenceSpeakers."""
+        return ndb.Key(ConferenceSpeakers, 'speakers', parent=c_key)
+
+
+    @staticmethod
+    def _addSessionsToAggregate(agg, sessions):
+        """Add sessions under their speakers, skipping sessions already
+        listed; the last speaker to reach more than one session becomes
+        the featured speaker. Return whether agg changed."""
+        speakers = agg.speakerSessions or {}
+        changed = agg.speakerSessions is None
+        for session in sessions:
+            if not session.speakerId:
+                continue
+            names = speakers.setdefault(session.speakerId, {})
+            s_id = str(session.key.id())
+            if s_id in names:
+                continue
+            names[s_id] = session.name
+            changed = True
+            if len(names) > 1:
+                agg.featuredSpeakerId = session.speakerId
+        agg.speakerSessions = speakers
+        return changed
+
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def _addToSpeakerAggregateAsync(c_key, sessions):
+        """Add written sessions to the conference's speaker aggregate,
+        building it from all sessions if it does not exist; return it."""
+        a_key = ConferenceApi._speakerAggregateKey(c_key)
+        agg = yield a_key.get_async()
+        if not agg or agg.speakerSessions is None:
+            # sessions already written are included by the query
+            agg = ConferenceSpeakers(key=a_key)
+            written = yield Session.query(ancestor=c_key).fetch_async()
+            sessions = written + list(sessions)
+        if ConferenceApi._addSessionsToAggregate(agg, sessions):
+            yield agg.put_async()
+        raise ndb.Return(agg)
+
+
+    @staticmethod
+    @ndb.tasklet
+    def _scheduleFeaturedSpeakerCheckAsync(websafeConfKey):
+        """Enqueue a featured speaker check unless one is pending for the
+        conference already. Call only once new sessions are committed to
+        the speaker aggregate: a pending check clears its flag before
+        reading the aggregate, so it sees them."""
+        ctx = ndb.get_context()
+        flag = MEMCACHE_FEATURED_PENDING_PREFIX + websafeConfKey
+        # the flag expires eventually in case the task is lost
+        added = yield ctx.memcache_add(flag, 1, time=FEATURED_SPEAKER_DELAY * 6)
+        if not added:
+            return
+        try:
+            yield taskqueue.Queue().add_async(taskqueue.Task(
+                params={'websafeConfKey': websafeConfKey},
+                url='/tasks/check_featured_speaker',
+                countdown=FEATURED_SPEAKER_DELAY
+            ))
+        except Exception:
+            yield ctx.memcache_delete(flag)
+            raise
+
+
+    @staticmethod
+    def _getFeaturedSpeaker(websafeConfKey):
+        """Return the featured speaker announcement of a conference from
+        its speaker aggregate ("" if there is none)."""
         # check that conference exists and get its key
         try:
             c_key = ndb.Key(urlsafe=websafeConfKey)
-            conf = c_key.get()
         except ProtocolBufferDecodeError:
             print('No conference found with key: %s' % websafeConfKey)
             raise 
 
-        # get sessions
-        sessions = Session.query(ancestor=c_key)
-        sessions = sessions.filter(Session.speakerId == speakerId)
+        agg = ConferenceApi._speakerAggregateKey(c_key).get()
+        if not agg or agg.speakerSessions is None:
+            # conference predates the aggregate; build it once, in the
+            # same transaction that session creation uses
+            if not c_key.get():
+                return ""
+            agg = ConferenceApi._addToSpeakerAggregateAsync(c_key, []).get_result()
+        if not agg.featuredSpeakerId:
+            return ""
+
+        # get Speaker from datastore
+        speaker = ndb.Key(Speaker, agg.featuredSpeakerId).get()
+        names = agg.speakerSessions[agg.featuredSpeakerId]
+        speakerNames = ", ".join(names[s_id] for s_id in
+                                 sorted(names, key=int))
+        return "Featured speaker: " + \
+            (speaker.name if speaker else agg.featuredSpeakerId) + \
+            " with sessions " + speakerNames
 
-        if sessions.count(limit=2) > 1:
-            speakerNames = ", ".join(session.name for session in sessions)
 
-            # get Speaker from datastore
-            s_key = ndb.Key(Speaker, speakerId) 
-            speaker = s_key.get()
-            featuredSpeaker = "Featured speaker: " + speaker.name + \
-                " with sessions " + speakerNames
+    @staticmethod
+    def _checkFeaturedSpeaker(websafeConfKey):
+        """Check if a speaker should be featured (has more sessions
+            in conf). If so, add to memcache with sessions"""
+        # clear the pending flag first, so sessions created from here on
+        # schedule another check
+        memcache.delete(MEMCACHE_FEATURED_PENDING_PREFIX + websafeConfKey)
 
+        featuredSpeaker = ConferenceApi._getFeaturedSpeaker(websafeConfKey)
+        if featuredSpeaker:
             memcache.set(websafeConfKey, featuredSpeaker)
             return True
-
         return False
- 
+
 
     @endpoints.method(CONF_GET_REQUEST, StringMessage,
             path='conference/{websafeConferenceKey}/getFeaturedSpeaker',
             http_method='GET', name='getFeaturedSpeaker')
+    @instrumented
     def getFeaturedSpeaker(self, request):
         """Return featured speaker from memcache."""
-        return StringMessage(data=memcache.get(request.websafeConferenceKey) or "")
+        featuredSpeaker = memcache.get(request.websafeConferenceKey)
+        if featuredSpeaker is None:
+            # not cached; read it from the aggregate and cache it
+            featuredSpeaker = self._getFeaturedSpeaker(request.websafeConferenceKey)
+            memcache.set(request.websafeConferenceKey, featuredSpeaker)
+        return StringMessage(data=featuredSpeaker)
 
 
     @endpoints.method(message_types.VoidMessage, SessionForms,
             path='queryPlayground',
             http_method='GET', name='queryPlayground')
+    @instrumented
     def queryPlayground(self, request):
         """Query Playground"""
         q = Session.query()
@@ -924,6 +2232,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_IN_TOWN_REQUEST, ConferenceForms,
             path="getConfsInTownInInterval",
             http_method='GET', name='getConfsInTownInInterval')
+    @instrumented
     def getConfsInTownInInterval(self, request):
         """See what conferences are in a certain town and 
             are scheduled to start in a given time interval."""
@@ -934,24 +2243,26 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.startDate >= startDate)
         q = q.filter(Conference.startDate <= endDate)
         
-        return ConferenceForms(
-            items = [self._copyConferenceToForm(conf, "") for conf in q]
-        )
+        return self._copyConferencesToForms(q)
 
 
     @endpoints.method(CONF_POPULAR_REQUEST, ConferenceForms,
             path="getPopularConferences",
             http_method='GET', name='getPopularConferences')
+    @instrumented
     def getPopularConferences(self, request):
         """Get popular conferences on a given topic."""
         q = Conference.query()
         q = q.filter(Conference.topics == request.topic)
-        q = q.filter(Conference.maxAttendees >= 100)
-        q = q.filter(Conference.seatsAvailable.IN(range(1,20)))
+        if self._backfillDone('conferencePopular'):
+            q = q.filter(Conference.popular == True)
+        else:
+            # not every conference has the flag yet
+            q = q.filter(Conference.maxAttendees >= POPULAR_MIN_ATTENDEES)
+            q = q.filter(Conference.seatsAvailable.IN(
+                range(1, POPULAR_MAX_SEATS + 1)))
         
-        return ConferenceForms(
-            items = [self._copyConferenceToForm(conf, "") for conf in q]
-        )
+        return self._copyConferencesToForms(q)
 
 
 
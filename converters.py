@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Udacity conference server-side Python App Engine entity -> ProtoRPC
+form converters
+
+$Id$
+
+created/forked from conference.py on 2026 oct 18
+
+"""
+
+from models import Attendee
+from models import AttendeeForm
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+from models import Speaker
+from models import SpeakerForm
+from models import TeeShirtSize
+
+_CONVERTERS = {}
+
+
+def compileConverter(model, message, **conversions):
+    """Return fn(entity, **extra) -> message for a model/message pair.
+
+    Which form fields are copied, and how each value is converted, is
+    worked out once here instead of per entity: a field is copied if the
+    model has a property of that name (through conversions[name] if
+    given) and websafeKey is filled from the entity key. Keyword
+    arguments passed to fn are set on the form as they are, skipping
+    empty values.
+    """
+    copies = []
+    for field in message.all_fields():
+        if field.name in model._properties:
+            copies.append((field.name, conversions.get(field.name)))
+    with_key = 'websafeKey' in [field.name for field in message.all_fields()]
+
+    def convert(entity, **extra):
+        values = {}
+        for name, conversion in copies:
+            value = getattr(entity, name)
+            values[name] = conversion(value) if conversion else value
+        if with_key:
+            values['websafeKey'] = entity.key.urlsafe()
+        for name, value in extra.iteritems():
+            if value:
+                values[name] = value
+        form = message(**values)
+        form.check_initialized()
+        return form
+    return convert
+
+
+def registerConverter(model, message, **conversions):
+    """Compile and register the converter for a model/message pair."""
+    _CONVERTERS[(model, message)] = compileConverter(model, message, **conversions)
+
+
+def copyToForm(entity, message, **extra):
+    """Copy entity to a new message using its registered converter."""
+    return _CONVERTERS[(type(entity), message)](entity, **extra)
+
+
+def _formatTime(value):
+    """Format a session start time, 'N/A' if not set."""
+    if value:
+        return value.strftime('%H:%M')
+    return 'N/A'
+
+
+def _toTeeShirtSize(value):
+    """Convert t-shirt string to Enum."""
+    return getattr(TeeShirtSize, value)
+
+
+def _toUrlsafeKeys(keys):
+    """Convert a list of Keys to websafe strings."""
+    return [key.urlsafe() for key in keys]
+
+
+# dates are converted to date strings; everything else is just copied
+registerConverter(Conference, ConferenceForm, startDate=str, endDate=str)
+registerConverter(Session, SessionForm, date=str, startTime=_formatTime)
+registerConverter(Speaker, SpeakerForm)
+registerConverter(Attendee, AttendeeForm, registered=str)
+registerConverter(Profile, ProfileForm, teeShirtSize=_toTeeShirtSize,
+                  sessionWishlist=_toUrlsafeKeys)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""instrumentation.py
+
+Udacity conference server-side Python App Engine per call latency and
+RPC accounting for API methods and HTTP handlers
+
+$Id$
+
+created on 2026 oct 18
+
+"""
+
+import collections
+import functools
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+MEMCACHE_INSTRUMENTATION_PREFIX = "INSTRUMENTATION_"
+MEMCACHE_INSTRUMENTED_NAMES_KEY = "INSTRUMENTED_NAMES"
+NAMES_CAS_ATTEMPTS = 5
+
+# upper bounds of the latency histogram buckets; slower calls are counted
+# in one more, open ended bucket
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# RPCs aggregated by type; everything else is counted as 'other'
+RPC_TYPES = (
+    'datastore_v3.Get',
+    'datastore_v3.Put',
+    'datastore_v3.Delete',
+    'datastore_v3.RunQuery',
+    'datastore_v3.Next',
+    'datastore_v3.BeginTransaction',
+    'datastore_v3.Commit',
+    'datastore_v3.Rollback',
+    'memcache.Get',
+    'memcache.Set',
+    'memcache.Delete',
+    'memcache.Increment',
+    'memcache.BatchIncrement',
+    'taskqueue.BulkAdd',
+    'urlfetch.Fetch',
+)
+
+COUNTERS = ('calls', 'errors', 'totalMs', 'entitiesRead',
+            'entitiesWritten', 'cacheHits', 'cacheMisses')
+
+_active = threading.local()
+_announced = set()
+
+
+class CallStats(object):
+    """CallStats -- what one instrumented call cost"""
+    def __init__(self, name):
+        self.name = name
+        self.ms = 0
+        self.error = False
+        self.rpcs = collections.Counter()
+        self.entitiesRead = 0
+        self.entitiesWritten = 0
+        self.cacheHits = 0
+        self.cacheMisses = 0
+
+    def countRpc(self, service, call, request, response):
+        self.rpcs['%s.%s' % (service, call)] += 1
+        if service == 'datastore_v3':
+            if call == 'Get':
+                self.entitiesRead += sum(1 for e in response.entity_list()
+                                         if e.has_entity())
+            elif call in ('RunQuery', 'Next'):
+                self.entitiesRead += response.result_size()
+            elif call == 'Put':
+                self.entitiesWritten += request.entity_size()
+            elif call == 'Delete':
+                self.entitiesWritten += request.key_size()
+        elif service == 'memcache' and call == 'Get':
+            hits = response.item_size()
+            self.cacheHits += hits
+            self.cacheMisses += request.key_size() - hits
+
+    def record(self):
+        """Return the stats as a JSON serialisable dict."""
+        return {
+            'name': self.name,
+            'ms': self.ms,
+            'error': self.error,
+            'rpcs': dict(self.rpcs),
+            'entitiesRead': self.entitiesRead,
+            'entitiesWritten': self.entitiesWritten,
+            'cacheHits': self.cacheHits,
+            'cacheMisses': self.cacheMisses,
+        }
+
+    def counters(self):
+        """Return the deltas this call adds to the aggregated counters."""
+        offsets = {
+            'calls': 1,
+            'errors': int(self.error),
+            'totalMs': self.ms,
+            'entitiesRead': self.entitiesRead,
+            'entitiesWritten': self.entitiesWritten,
+            'cacheHits': self.cacheHits,
+            'cacheMisses': self.cacheMisses,
+            'latency_%d' % _latencyBucket(self.ms): 1,
+        }
+        for rpc, count in self.rpcs.iteritems():
+            if rpc not in RPC_TYPES:
+                rpc = 'other'
+            key = 'rpc_' + rpc
+            offsets[key] = offsets.get(key, 0) + count
+        return dict((k, v) for k, v in offsets.iteritems() if v)
+
+
+def _latencyBucket(ms):
+    """Return the index of the histogram bucket for a latency."""
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if ms <= bound:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+
+def _countRpc(service, call, request, response):
+    """apiproxy post call hook; charges the RPC to the active call."""
+    stats = getattr(_active, 'stats', None)
+    if stats is not None:
+        stats.countRpc(service, call, request, response)
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrumentation', _countRpc)
+
+
+def _announce(name):
+    """Add name to the list of instrumented names kept in memcache."""
+    client = memcache.Client()
+    for i in range(NAMES_CAS_ATTEMPTS):
+        names = client.gets(MEMCACHE_INSTRUMENTED_NAMES_KEY)
+        if names is None:
+            if client.add(MEMCACHE_INSTRUMENTED_NAMES_KEY, [name]):
+                break
+        elif name in names or \
+                client.cas(MEMCACHE_INSTRUMENTED_NAMES_KEY, names + [name]):
+            break
+    _announced.add(name)
+
+
+def _record(stats):
+    """Log one call and add it to the aggregated counters."""
+    logging.info('instrumentation %s', json.dumps(stats.record()))
+    counts = memcache.offset_multi(stats.counters(),
+        key_prefix='%s%s_' % (MEMCACHE_INSTRUMENTATION_PREFIX, stats.name),
+        initial_value=0)
+    # (re-)announce names new to this instance or to memcache
+    if stats.name not in _announced or (counts or {}).get('calls') == 1:
+        _announce(stats.name)
+
+
+def instrumented(method):
+    """Decorator recording time and RPCs of each call to a ConferenceApi
+    method or request handler method, named Class.method.
+
+    Calls made from within an instrumented call are charged to it.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(_active, 'stats', None) is not None:
+            return method(self, *args, **kwargs)
+
+        stats = _active.stats = CallStats(
+            '%s.%s' % (type(self).__name__, method.__name__))
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            stats.error = True
+            raise
+        finally:
+            _active.stats = None
+            stats.ms = int((time.time() - start) * 1000)
+            _record(stats)
+    return wrapper
+
+
+def getStats():
+    """Return {name: {counter: value}} of all instrumented names; counters
+    are COUNTERS, latency_<bucket> and rpc_<type>."""
+    names = memcache.get(MEMCACHE_INSTRUMENTED_NAMES_KEY) or []
+    suffixes = list(COUNTERS)
+    suffixes += ['latency_%d' % i for i in range(len(LATENCY_BUCKETS_MS) + 1)]
+    suffixes += ['rpc_' + rpc for rpc in RPC_TYPES + ('other',)]
+    keys = ['%s_%s' % (name, suffix) for name in names for suffix in suffixes]
+    counts = memcache.get_multi(keys, key_prefix=MEMCACHE_INSTRUMENTATION_PREFIX)
+    return dict(
+        (name, dict((suffix, counts.get('%s_%s' % (name, suffix), 0))
+                    for suffix in suffixes))
+        for name in names)
@@ -15,16 +15,36 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from instrumentation import instrumented
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
+    @instrumented
     def get(self):
         """Set Announcement in Memcache."""
         ConferenceApi._cacheAnnouncement()
         self.response.set_status(204)
 
 
+class MigrateRegistrationsCronHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Start moving registrations off websafe strings, if needed."""
+        ConferenceApi._scheduleRegistrationMigration()
+        self.response.set_status(204)
+
+
+class BackfillCronHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Start the backfills that have not finished."""
+        ConferenceApi._scheduleBackfills()
+        self.response.set_status(204)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
+    @instrumented
     def post(self):
         """Send email confirming Conference creation."""
         mail.send_mail(
@@ -39,16 +59,79 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
 
 
 class CheckFeaturedSpeakerHandler(webapp2.RequestHandler):
+    @instrumented
     def post(self):
         """See if speaker is featured, if so, add to Memcache."""
         ConferenceApi._checkFeaturedSpeaker(
+            self.request.get('websafeConfKey'))
+        self.response.set_status(204)
+
+
+class SyncSeatsAvailableHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Copy sharded seat count back onto the Conference."""
+        ConferenceApi._syncSeatsAvailable(
+            self.request.get('websafeConfKey'))
+        self.response.set_status(204)
+
+
+class ReconcileNearlySoldOutHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Re-check a conference's place in the NearlySoldOut set."""
+        ConferenceApi._reconcileNearlySoldOut(
+            [ndb.Key(urlsafe=self.request.get('websafeConfKey'))])
+        self.response.set_status(204)
+
+
+class PruneWishlistHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Remove deleted sessions from a user's wishlist."""
+        ConferenceApi._pruneWishlist(
+            self.request.get('userId'),
+            self.request.get_all('sessionKey'))
+        self.response.set_status(204)
+
+
+class IndexRosterHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Add earlier registrations to a conference's attendee roster."""
+        ConferenceApi._indexRoster(
             self.request.get('websafeConfKey'),
-            self.request.get('speakerId'))
+            self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class MigrateRegistrationsHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Migrate one batch of Profiles' registrations to keys."""
+        ConferenceApi._migrateRegistrationBatch(
+            self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class BackfillHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Re-put one batch of entities of a backfill."""
+        ConferenceApi._backfillBatch(self.request.get('name'))
         self.response.set_status(204)
 
 
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/migrate_registrations', MigrateRegistrationsCronHandler),
+    ('/crons/backfill', BackfillCronHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/check_featured_speaker', CheckFeaturedSpeakerHandler),
+    ('/tasks/sync_seats_available', SyncSeatsAvailableHandler),
+    ('/tasks/reconcile_nearly_sold_out', ReconcileNearlySoldOutHandler),
+    ('/tasks/prune_wishlist', PruneWishlistHandler),
+    ('/tasks/index_roster', IndexRosterHandler),
+    ('/tasks/migrate_registrations', MigrateRegistrationsHandler),
+    ('/tasks/backfill', BackfillHandler),
 ], debug=True)
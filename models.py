@@ -15,6 +15,7 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 import httplib
 import endpoints
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 class ConflictException(endpoints.ServiceException):
@@ -26,7 +27,10 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy websafe keys; read alongside conferencesToAttend until the
+    # registration migration has moved them all
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    conferencesToAttend = ndb.KeyProperty(kind='Conference', repeated=True)
     sessionWishlist = ndb.KeyProperty(kind='Session', repeated=True)
 
 class ProfileMiniForm(messages.Message):
@@ -42,14 +46,68 @@ class ProfileForm(messages.Message):
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
     sessionWishlist = messages.StringField(5, repeated=True)
 
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- one session on a user's wishlist; child of the
+    Profile, with the session's websafe key as id"""
+    added = ndb.DateTimeProperty(auto_now_add=True)
+
+class WishlistForm(messages.Message):
+    """WishlistForm -- websafe session keys to add to/remove from wishlist"""
+    add = messages.StringField(1, repeated=True)
+    remove = messages.StringField(2, repeated=True)
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
 
+class CacheStatsForm(messages.Message):
+    """CacheStatsForm -- hit/miss counters of one server side cache"""
+    name = messages.StringField(1)
+    hits = messages.IntegerField(2)
+    misses = messages.IntegerField(3)
+
+class CacheStatsForms(messages.Message):
+    """CacheStatsForms -- multiple CacheStatsForm outbound form message"""
+    items = messages.MessageField(CacheStatsForm, 1, repeated=True)
+
+class LatencyBucketForm(messages.Message):
+    """LatencyBucketForm -- calls no slower than upperMs (open ended if
+    unset)"""
+    upperMs = messages.IntegerField(1)
+    count = messages.IntegerField(2)
+
+class RpcCountForm(messages.Message):
+    """RpcCountForm -- number of RPCs of one type"""
+    name = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+class InstrumentationForm(messages.Message):
+    """InstrumentationForm -- aggregated cost of one API method or handler"""
+    name = messages.StringField(1)
+    calls = messages.IntegerField(2)
+    errors = messages.IntegerField(3)
+    totalMs = messages.IntegerField(4)
+    latency = messages.MessageField(LatencyBucketForm, 5, repeated=True)
+    rpcs = messages.MessageField(RpcCountForm, 6, repeated=True)
+    entitiesRead = messages.IntegerField(7)
+    entitiesWritten = messages.IntegerField(8)
+    cacheHits = messages.IntegerField(9)
+    cacheMisses = messages.IntegerField(10)
+
+class InstrumentationForms(messages.Message):
+    """InstrumentationForms -- multiple InstrumentationForm outbound form message"""
+    items = messages.MessageField(InstrumentationForm, 1, repeated=True)
+
+# a conference is popular if it is big and has only a few seats left
+POPULAR_MIN_ATTENDEES = 100
+POPULAR_MAX_SEATS = 19
+
 class Conference(ndb.Model):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
@@ -62,6 +120,56 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    seatShards      = ndb.IntegerProperty(default=0)
+    # registered users, counted here unless the conference is sharded;
+    # rosterIndexed once every one of them has an Attendee
+    attendees       = ndb.IntegerProperty(default=0, indexed=False)
+    rosterIndexed   = ndb.BooleanProperty(default=False, indexed=False)
+    updated         = ndb.DateTimeProperty(auto_now=True)
+    popular         = ndb.ComputedProperty(
+        lambda self: (self.maxAttendees or 0) >= POPULAR_MIN_ATTENDEES and
+                     0 < (self.seatsAvailable or 0) <= POPULAR_MAX_SEATS)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a Conference's available seats"""
+    conference      = ndb.KeyProperty(kind='Conference', required=True)
+    seatsAvailable  = ndb.IntegerProperty(default=0, indexed=False)
+    attendees       = ndb.IntegerProperty(default=0, indexed=False)
+
+class Attendee(ndb.Model):
+    """Attendee -- one user registered for a Conference; a root entity so
+    registrations don't contend on one entity group"""
+    conference      = ndb.KeyProperty(kind='Conference', required=True)
+    userId          = ndb.StringProperty(required=True, indexed=False)
+    registered      = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+class AttendeeForm(messages.Message):
+    """AttendeeForm -- Attendee outbound form message"""
+    userId = messages.StringField(1)
+    displayName = messages.StringField(2)
+    registered = messages.StringField(3)
+
+class AttendeeForms(messages.Message):
+    """AttendeeForms -- a page of AttendeeForm outbound form messages;
+    complete once registrations from before the roster are included"""
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    complete = messages.BooleanField(3)
+
+class AttendeeCountForm(messages.Message):
+    """AttendeeCountForm -- number of users registered for a Conference"""
+    count = messages.IntegerField(1)
+    complete = messages.BooleanField(2)
+    
+class Backfill(ndb.Model):
+    """Backfill -- progress of re-putting every entity of a kind"""
+    cursor          = ndb.StringProperty(indexed=False)
+    done            = ndb.BooleanProperty(default=False, indexed=False)
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- websafe key -> name of conferences with only a
+    few seats left, kept up to date by registrations"""
+    conferenceNames = ndb.JsonProperty()
     
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -77,10 +185,16 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    seatShards      = messages.IntegerField(13)
     
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    etag = messages.StringField(3)
+    notModified = messages.BooleanField(4)
+    queryPlan = messages.StringField(5)
+    missing = messages.StringField(6, repeated=True)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -109,6 +223,8 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
 
 
 class Speaker(ndb.Model):
@@ -116,6 +232,13 @@ class Speaker(ndb.Model):
     name = ndb.StringProperty(required=True)
     bio = ndb.StringProperty()
     email = ndb.StringProperty(required=True)
+    # lowercase name and email, for prefix search
+    searchTerms = ndb.ComputedProperty(
+        lambda self: [term.lower() for term in (self.name, self.email) if term],
+        repeated=True)
+    # keys of the speaker's sessions; complete once sessionsIndexed
+    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True, indexed=False)
+    sessionsIndexed = ndb.BooleanProperty(default=False, indexed=False)
 
 class SpeakerForm(messages.Message):
     name = messages.StringField(1)
@@ -124,7 +247,11 @@ class SpeakerForm(messages.Message):
 
 class SpeakerForms(messages.Message):
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
 
+# rendered SessionForms are cached under this prefix + websafe key
+MEMCACHE_SESSION_PREFIX = "SESSION_"
 
 class Session(ndb.Model):
     """Session -- Session object for conferences"""
@@ -137,6 +264,25 @@ class Session(ndb.Model):
     startTime = ndb.TimeProperty()
     location = ndb.StringProperty()
 
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        # a cached form must not outlive its session
+        memcache.delete(MEMCACHE_SESSION_PREFIX + key.urlsafe())
+
+
+class ConferenceSpeakers(ndb.Model):
+    """ConferenceSpeakers -- speakerId -> {session id: session name} of a
+    Conference, kept up to date as sessions are created"""
+    speakerSessions = ndb.JsonProperty()
+    featuredSpeakerId = ndb.StringProperty(indexed=False)
+
+
+class ConferenceSchedule(ndb.Model):
+    """ConferenceSchedule -- all sessions of a Conference, rendered as
+    SessionForms JSON and rebuilt when they change"""
+    forms = ndb.TextProperty()
+    etag = ndb.StringProperty(indexed=False)
+
 
 class SessionForm(messages.Message):
     name = messages.StringField(1)
@@ -153,5 +299,17 @@ class SessionForm(messages.Message):
 
 class SessionForms(messages.Message):
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+    nextPageToken = messages.StringField(4)
+
+class ConferenceDetailForm(messages.Message):
+    """ConferenceDetailForm -- a conference with its sessions and the
+    caller's relation to it"""
+    conference = messages.MessageField(ConferenceForm, 1)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+    isAttending = messages.BooleanField(3)
+    isOwner = messages.BooleanField(4)
+    wishlist = messages.StringField(5, repeated=True)
 
 
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""queryplanner.py
+
+Udacity conference server-side Python App Engine query planner for
+queryConferences
+
+$Id$
+
+created on 2026 oct 18
+
+"""
+
+import operator
+
+from google.appengine.ext import ndb
+
+from models import Conference
+
+# composite indexes declared in index.yaml for queryConferences, as the
+# indexed properties in index order; every one ends with the name sort.
+# An index serves equality filters on all its other properties, or
+# equality filters on all but the last plus inequalities on the last.
+CONFERENCE_INDEXES = (
+    ('city', 'name'),
+    ('topics', 'name'),
+    ('month', 'name'),
+    ('maxAttendees', 'name'),
+    ('city', 'topics', 'name'),
+    ('city', 'month', 'name'),
+    ('city', 'maxAttendees', 'name'),
+    ('topics', 'month', 'name'),
+    ('topics', 'maxAttendees', 'name'),
+)
+
+# rough fraction of conferences matching a filter, used to rank plans
+SELECTIVITY = {
+    'city': 0.05,
+    'topics': 0.1,
+    'month': 1 / 12.0,
+    'maxAttendees': 0.1,
+}
+INEQUALITY_SELECTIVITY = 0.5
+
+SCAN_BATCH_SIZE = 100       # entities per datastore batch when filtering
+MAX_SCAN = 1000             # entities scanned per page at most
+
+COMPARATORS = {
+    '=':  operator.eq,
+    '!=': operator.ne,
+    '>':  operator.gt,
+    '>=': operator.ge,
+    '<':  operator.lt,
+    '<=': operator.le,
+}
+
+
+def _matches(entity, field, op, value):
+    """Return whether entity passes one filter, with datastore semantics
+    for repeated properties (any value may match)."""
+    values = getattr(entity, field)
+    if not isinstance(values, list):
+        values = [values]
+    compare = COMPARATORS[op]
+    return any(compare(v, value) for v in values)
+
+
+class QueryPlan(object):
+    """QueryPlan -- how a set of Conference filters is run: the filters
+    pushed to the datastore, the index serving them, and the filters
+    left to apply in memory"""
+    def __init__(self, index, pushed, residual, inequality):
+        self.index = index
+        self.pushed = pushed
+        self.residual = residual
+        self.inequality = inequality
+
+    def query(self):
+        """Return the datastore query for the pushed filters."""
+        q = Conference.query()
+        for field, op, value in self.pushed:
+            q = q.filter(ndb.query.FilterNode(field, op, value))
+        # If exists, sort on inequality filter first
+        if self.inequality:
+            q = q.order(ndb.GenericProperty(self.inequality))
+        return q.order(Conference.name)
+
+    def matches(self, entity):
+        """Return whether entity passes the in memory filters."""
+        for field, op, value in self.residual:
+            if not _matches(entity, field, op, value):
+                return False
+        return True
+
+    def fetchPage(self, page_size, start_cursor=None, max_scan=MAX_SCAN):
+        """Return (results, cursor, more) like Query.fetch_page.
+
+        With in memory filters the query is streamed and at most max_scan
+        entities are read, so a page may come back short (or empty) with
+        more set; the cursor then continues after the last entity read.
+        """
+        if not self.residual:
+            return self.query().fetch_page(page_size,
+                                           start_cursor=start_cursor)
+
+        it = self.query().iter(start_cursor=start_cursor,
+                               produce_cursors=True,
+                               batch_size=SCAN_BATCH_SIZE)
+        results = []
+        cursor = None
+        scanned = 0
+        while len(results) < page_size and scanned < max_scan \
+                and it.has_next():
+            entity = it.next()
+            scanned += 1
+            if self.matches(entity):
+                results.append(entity)
+            cursor = it.cursor_after()
+        more = cursor is not None and it.has_next()
+        return results, cursor, more
+
+    def describe(self):
+        """Return a one line description of the plan."""
+        def fmt(filters):
+            return ', '.join('%s %s %r' % f for f in filters)
+        return 'index(%s) datastore[%s] memory[%s]' % (
+            ','.join(self.index or ('name',)),
+            fmt(self.pushed), fmt(self.residual))
+
+
+def _servedShapes(index):
+    """Yield (equality fields, inequality field) served by an index."""
+    props = index[:-1]
+    yield frozenset(props), None
+    yield frozenset(props[:-1]), props[-1]
+
+
+def planQuery(filters):
+    """Return the cheapest QueryPlan for (field, operator, value) filters.
+
+    Only index shapes declared in CONFERENCE_INDEXES are sent to the
+    datastore, so no filter combination needs an index that is not in
+    index.yaml; whatever a plan cannot push is applied in memory. Plans
+    are ranked by the estimated fraction of conferences they read.
+    """
+    # one equality filter per field can be pushed; '!=' never is, as the
+    # datastore runs it as two queries
+    equalities = {}
+    inequalities = {}
+    for field, op, value in filters:
+        if op == '=':
+            equalities.setdefault(field, (field, op, value))
+        elif op != '!=':
+            inequalities.setdefault(field, []).append((field, op, value))
+
+    # a full scan in name order needs no composite index
+    candidates = [((), frozenset(), None)]
+    for index in CONFERENCE_INDEXES:
+        for eq_fields, ineq_field in _servedShapes(index):
+            if not eq_fields <= set(equalities):
+                continue
+            if ineq_field and ineq_field not in inequalities:
+                continue
+            candidates.append((index, eq_fields, ineq_field))
+
+    def cost(candidate):
+        index, eq_fields, ineq_field = candidate
+        estimate = 1.0
+        for field in eq_fields:
+            estimate *= SELECTIVITY.get(field, 1.0)
+        if ineq_field:
+            estimate *= INEQUALITY_SELECTIVITY
+        # prefer the smaller index on a tie
+        return estimate, len(index)
+
+    index, eq_fields, ineq_field = min(candidates, key=cost)
+    pushed = [equalities[field] for field in sorted(eq_fields)]
+    if ineq_field:
+        pushed.extend(inequalities[ineq_field])
+    residual = [f for f in filters if f not in pushed]
+    return QueryPlan(index, pushed, residual, ineq_field)
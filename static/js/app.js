@@ -81,6 +81,7 @@ app.filter('startFrom', function () {
  *
  */
 app.constant('HTTP_ERRORS', {
+    'BAD_REQUEST': 400,
     'UNAUTHORIZED': 401
 });
 
@@ -534,16 +534,36 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Retrieves the conferences to attend by calling the conference.getProfile method and
-     * invokes the conference.getConference method n times where n == the number of the conferences to attend.
+     * Retrieves the conferences to attend by calling the conference.getConferencesToAttend method
+     * page by page until all of them are shown.
      */
     $scope.getConferencesAttend = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
+        $scope.conferences = [];
+        $scope.getConferencesAttendPage(null);
+    };
+
+    /**
+     * Appends one page of conferences to attend and requests the next one, if any.
+     *
+     * @param pageToken the token of the page to get; null for the first page.
+     */
+    $scope.getConferencesAttendPage = function (pageToken) {
+        var params = {pageSize: 100};
+        if (pageToken) {
+            params.pageToken = pageToken;
+        }
+        gapi.client.conference.getConferencesToAttend(params).
             execute(function (resp) {
                 $scope.$apply(function () {
                     if (resp.error) {
                         // The request has failed.
+                        if (pageToken && resp.code && resp.code == HTTP_ERRORS.BAD_REQUEST) {
+                            // The registrations changed while paging; start over.
+                            $scope.conferences = [];
+                            $scope.getConferencesAttendPage(null);
+                            return;
+                        }
                         var errorMessage = resp.error.message || '';
                         $scope.messages = 'Failed to query the conferences to attend : ' + errorMessage;
                         $scope.alertStatus = 'warning';
@@ -555,7 +575,11 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         }
                     } else {
                         // The request has succeeded.
-                        $scope.conferences = resp.result.items;
+                        $scope.conferences = $scope.conferences.concat(resp.result.items || []);
+                        if (resp.result.nextPageToken) {
+                            $scope.getConferencesAttendPage(resp.result.nextPageToken);
+                            return;
+                        }
                         $scope.loading = false;
                         $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
                         $scope.alertStatus = 'success';
@@ -589,34 +613,13 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
-     * Also gets the conference's sessions.
+     * Invokes the conference.getConferenceDetail method and sets the returned conference,
+     * its sessions and the user's attendance and wishlist in the $scope.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferenceSessions({
-            websafeConferenceKey: $routeParams.websafeConferenceKey
-        }).execute(function (resp){
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // failed to get sessions
-                    var errorMessage = resp.error.message || '';
-                    $scope.messages = 'Failed to load current conference sessions : ' + errorMessage;
-                    $scope.alertStatus = 'warning';
-                    $log.error($scope.messages);
-                } else {
-                    $scope.sessions = resp.result.items;
-                    $scope.alertStatus = 'success';
-                    $scope.messages = 'Conference sessions retrieved successfully';
-                    $log.info($scope.messages); 
-                }
-            });
-        });
-
-        $scope.loading = true;
-        gapi.client.conference.getConference({
+        gapi.client.conference.getConferenceDetail({
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
@@ -630,42 +633,21 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                     $log.error($scope.messages);
                 } else {
                     // The request has succeeded.
+                    var detail = resp.result;
+                    $scope.conference = detail.conference;
+                    $scope.sessions = detail.sessions;
+                    $scope.wishlist = detail.wishlist || [];
+                    $scope.isOwner = detail.isOwner;
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
-                }
-            });
-        });
-
-        $scope.loading = true;
-        // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // Failed to get a user profile.
-                } else {
-                    var profile = resp.result;
-                    if (profile.sessionWishlist) {
-                        $scope.wishlist = profile.sessionWishlist;
-                    }
-                    if ($scope.conference.organizerUserId == profile.mainEmail) {
-                        $scope.isOwner = true;
-                    }
-                    if (profile.conferenceKeysToAttend) {
-                        for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                            if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
-                                // The user is attending the conference.
-                                $scope.alertStatus = 'info';
-                                $scope.messages = 'You are attending this conference';
-                                $scope.isUserAttending = true;
-                            }
-                        }
+                    if (detail.isAttending) {
+                        // The user is attending the conference.
+                        $scope.alertStatus = 'info';
+                        $scope.messages = 'You are attending this conference';
+                        $scope.isUserAttending = true;
                     }
                 }
             });
         });
-
-        
     };
 
 
@@ -877,14 +859,20 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
  * A controller used for the Create session page.
  */
 conferenceApp.controllers.controller('CreateSessionCtrl',
-    function ($scope, $log, $routeParams, typeOfSessions, HTTP_ERRORS) {
+    function ($scope, $log, $q, $routeParams, typeOfSessions, HTTP_ERRORS) {
 
         /**
          * The conference object being edited in the page.
          * @type {{}|*}
          */
         $scope.session = $scope.session || {};
-        $scope.speakers = [];
+
+        /**
+         * The speaker chosen in the speaker picker; an object so that the typeahead
+         * can set it from its child scope.
+         * @type {{speaker: {}|undefined}}
+         */
+        $scope.picker = {};
         $scope.conference = {};
         $scope.typeOfSessions = typeOfSessions;
 
@@ -970,26 +958,52 @@ conferenceApp.controllers.controller('CreateSessionCtrl',
                     }
                 });
             });
+        }
 
-            $scope.loading = true;
-            gapi.client.conference.getSpeakers().execute(function (resp){
+        /**
+         * Looks up the speakers whose name or email starts with what was typed into
+         * the speaker picker, one short page at a time.
+         *
+         * @param prefix the text typed so far.
+         * @returns a promise of the matching speakers.
+         */
+        $scope.searchSpeakers = function (prefix) {
+            var deferred = $q.defer();
+            gapi.client.conference.getSpeakers({prefix: prefix, pageSize: 10}).execute(function (resp) {
                 $scope.$apply(function () {
-                    $scope.loading = false;
                     if (resp.error) {
-                        // failed to get sessions
+                        // failed to get speakers
                         var errorMessage = resp.error.message || '';
                         $scope.messages = 'Failed to load speakers : ' + errorMessage;
                         $scope.alertStatus = 'warning';
                         $log.error($scope.messages);
+                        deferred.resolve([]);
                     } else {
-                        $scope.speakers = resp.result.items;
-                        $scope.alertStatus = 'success';
-                        $scope.messages = 'Conference speakers retrieved successfully';
-                        $log.info($scope.messages);                         
+                        // a speaker may match on both name and email
+                        var seen = {};
+                        deferred.resolve((resp.result.items || []).filter(function (speaker) {
+                            if (seen[speaker.email]) {
+                                return false;
+                            }
+                            seen[speaker.email] = true;
+                            return true;
+                        }));
                     }
                 });
             });
-        }
+            return deferred.promise;
+        };
+
+        /**
+         * Keeps session.speakerId in step with the speaker picker.
+         */
+        $scope.pickSpeaker = function () {
+            if ($scope.picker.speaker) {
+                $scope.session.speakerId = $scope.picker.speaker.email;
+            } else {
+                delete $scope.session.speakerId;
+            }
+        };
 
         /**
          * Invokes the conference.createSession API.
@@ -1024,6 +1038,7 @@ conferenceApp.controllers.controller('CreateSessionCtrl',
                             $scope.alertStatus = 'success';
                             $scope.submitted = false;
                             $scope.session = {};
+                            $scope.picker = {};
                             $log.info($scope.messages + ' : ' + JSON.stringify(resp.result));
                         }
                     });
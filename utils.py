@@ -1,11 +1,230 @@
+import collections
+import hashlib
 import json
 import os
+import threading
 import time
 import uuid
 
+import endpoints
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 from models import Profile
 
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+TOKENINFO_DEADLINE = 5      # seconds per tokeninfo fetch
+TOKENINFO_ATTEMPTS = 3
+TOKENINFO_BACKOFF = 0.1     # seconds before the first retry, then doubled
+TOKEN_CACHE_SIZE = 1000     # tokens kept per instance
+TOKEN_CACHE_MAX_TTL = 300   # seconds, never longer than the token lives
+
+
+def fetchTokenInfo(token, token_type):
+    """Fetch tokeninfo for token from TOKENINFO_URL; return its JSON as a
+    dict, or an empty dict if the token could not be verified."""
+    return fetchTokenInfoAsync(token, token_type).get_result()
+
+
+@ndb.tasklet
+def fetchTokenInfoAsync(token, token_type):
+    """Async version of fetchTokenInfo.
+
+    Only transient failures (fetch errors, deadlines and 5xx responses)
+    are retried, after a short exponential backoff that yields to the
+    event loop instead of sleeping; other responses fail fast. An id
+    token rejected as invalid is retried as an access token within the
+    same TOKENINFO_ATTEMPTS.
+    """
+    ctx = ndb.get_context()
+    backoff = TOKENINFO_BACKOFF
+    for i in range(TOKENINFO_ATTEMPTS):
+        try:
+            resp = yield ctx.urlfetch(TOKENINFO_URL % (token_type, token),
+                                      deadline=TOKENINFO_DEADLINE)
+        except (urlfetch.DownloadError, urlfetch.DeadlineExceededError):
+            resp = None
+        if resp is not None and resp.status_code == 200:
+            raise ndb.Return(json.loads(resp.content))
+        elif resp is None or resp.status_code >= 500:
+            if i + 1 < TOKENINFO_ATTEMPTS:
+                yield ndb.sleep(backoff)
+                backoff *= 2
+        elif resp.status_code == 400 and 'invalid_token' in resp.content \
+                and token_type != 'access_token':
+            # not an id token; try it as an access token right away
+            token_type = 'access_token'
+        else:
+            break
+    raise ndb.Return({})
+
+
+class _Flight(object):
+    """_Flight -- a tokeninfo lookup other threads can wait on"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.user_id = ''
+
+
+class TokenInfoCache(object):
+    """TokenInfoCache -- bounded, thread safe TTL cache of token -> user_id
+
+    Entries expire with the token (tokeninfo's expires_in), capped at
+    max_ttl. Concurrent lookups of the same uncached token share a single
+    call to fetcher(token, token_type), which must return a tokeninfo dict.
+    """
+    def __init__(self, fetcher=fetchTokenInfo, size=TOKEN_CACHE_SIZE,
+                 max_ttl=TOKEN_CACHE_MAX_TTL, clock=time.time):
+        self._fetcher = fetcher
+        self._size = size
+        self._max_ttl = max_ttl
+        self._clock = clock
+        self._entries = collections.OrderedDict()   # key -> (expiry, user_id)
+        self._flights = {}                          # key -> _Flight
+        self._lock = threading.Lock()
+
+    def getUserId(self, token, token_type):
+        # only keep a digest of the token in memory
+        key = hashlib.sha256(token).hexdigest()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry[0] > self._clock():
+                # re-insert to keep least recently used entries first
+                self._entries[key] = entry
+                return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            return flight.user_id
+
+        ttl = 0
+        try:
+            info = self._fetcher(token, token_type)
+            flight.user_id = info.get('user_id', '')
+            ttl = min(int(info.get('expires_in', 0)), self._max_ttl)
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.user_id and ttl > 0:
+                    self._entries[key] = (self._clock() + ttl, flight.user_id)
+                    while len(self._entries) > self._size:
+                        self._entries.popitem(last=False)
+            flight.done.set()
+        return flight.user_id
+
+
+_token_cache = TokenInfoCache()
+
+
+def setTokenInfoFetcher(fetcher):
+    """Replace the tokeninfo fetcher (e.g. with one talking to a local
+    fake tokeninfo server); also starts with an empty cache."""
+    global _token_cache
+    _token_cache = TokenInfoCache(fetcher)
+
+
+class LocalCache(object):
+    """LocalCache -- small, thread safe, process local TTL cache"""
+    def __init__(self, size, ttl, clock=time.time):
+        self._size = size
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = collections.OrderedDict()   # key -> (expiry, value)
+        self._lock = threading.Lock()
+
+    def getMulti(self, keys):
+        """Return a dict of the keys found and not yet expired."""
+        now = self._clock()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry and entry[0] > now:
+                    found[key] = entry[1]
+                elif entry:
+                    del self._entries[key]
+        return found
+
+    def setMulti(self, mapping):
+        expiry = self._clock() + self._ttl
+        with self._lock:
+            for key, value in mapping.iteritems():
+                # re-insert so that the oldest entries are evicted first
+                self._entries.pop(key, None)
+                self._entries[key] = (expiry, value)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RequestContext(object):
+    """RequestContext -- the signed in user of one request, their user id
+    and their Profile, each looked up at most once"""
+    def __init__(self, request_id=None):
+        self.requestId = request_id
+        self._user = None
+        self._userId = None
+        self._userResolved = False
+        self._profile = None        # Future of the Profile (or None)
+
+    def user(self):
+        """Return the signed in user, or None."""
+        if not self._userResolved:
+            self._user = endpoints.get_current_user()
+            if self._user:
+                self._userId = getUserId(self._user)
+            self._userResolved = True
+        return self._user
+
+    def userId(self):
+        """Return the signed in user's id, or None."""
+        self.user()
+        return self._userId
+
+    def profileAsync(self, fresh=False):
+        """Return a Future of the user's Profile (None if there is none
+        yet). The first read is shared by the rest of the request; pass
+        fresh to read it again inside a transaction, and setProfile once
+        it is changed there."""
+        if fresh:
+            return ndb.Key(Profile, self.userId()).get_async()
+        if self._profile is None:
+            self._profile = ndb.Key(Profile, self.userId()).get_async()
+        return self._profile
+
+    def setProfile(self, profile):
+        """Remember profile as the user's Profile; inside a transaction,
+        only once it commits."""
+        def _set():
+            self._profile = ndb.Future()
+            self._profile.set_result(profile)
+        if ndb.in_transaction():
+            ndb.get_context().call_on_commit(_set)
+        else:
+            _set()
+
+
+_request = threading.local()
+
+
+def currentRequest():
+    """Return the RequestContext of the request being handled; outside
+    of a request, a new, unshared one each time."""
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    context = getattr(_request, 'context', None)
+    if request_id is None:
+        return RequestContext()
+    if context is None or context.requestId != request_id:
+        context = _request.context = RequestContext(request_id)
+    return context
+
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -17,22 +236,7 @@ def getUserId(user, id_type="email"):
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _token_cache.getUserId(token, token_type)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm